@@ -0,0 +1,88 @@
+import logging
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# can be pointed at a local mock server for testing and benchmarking
+TWITTER_API_URL = "https://api.twitter.com"
+API_BASE_URL = os.environ.get("TWITTER_API_BASE_URL", TWITTER_API_URL)
+
+# number of distinct hosts to keep pools for and connections kept alive per host
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 120)
+
+_session = None
+
+
+def get_bearer_tokens(credentials):
+    """Read one or more bearer tokens from a credentials dict ("bearer_token" or "bearer_tokens")."""
+    tokens = credentials.get("bearer_tokens") or credentials.get("bearer_token")
+    if isinstance(tokens, str):
+        tokens = [tokens]
+    if not tokens:
+        raise RuntimeError("could not load bearer token from credentials")
+    return list(tokens)
+
+
+class APISession(requests.Session):
+    # tweepy hardcodes the API host, so send its requests to API_BASE_URL here
+    def request(self, method, url, *args, **kwargs):
+        if API_BASE_URL != TWITTER_API_URL and url.startswith(TWITTER_API_URL):
+            url = api_url(url[len(TWITTER_API_URL):])
+        return super().request(method, url, *args, **kwargs)
+
+
+def make_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """Build a keep-alive session that reuses TCP/TLS connections between requests."""
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+    session = APISession()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+def configure_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=None):
+    """
+    Replace the shared session that api_get() sends every request through, so
+    the pages of a run reuse kept-alive connections instead of making a new
+    handshake per request. pool_maxsize (DEFAULT_POOL_MAXSIZE when None) is
+    the number of connections kept per host; raise it for concurrent fetching.
+    """
+    global _session
+    pool_maxsize = pool_maxsize or DEFAULT_POOL_MAXSIZE
+    if _session is not None:
+        _session.close()
+    _session = make_session(pool_connections, pool_maxsize)
+    logger.info("http session: pool_connections = {}, pool_maxsize = {}".format(pool_connections, pool_maxsize))
+    return _session
+
+
+def add_pool_size_argument(parser):
+    parser.add_argument("--pool_size", type=int, default=DEFAULT_POOL_MAXSIZE,
+                        help="number of keep-alive connections to pool (optional)")
+
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+def api_url(path):
+    return API_BASE_URL.rstrip("/") + path
+
+
+def api_get(bearer_token, path, params):
+    headers = {"Authorization": "Bearer {}".format(bearer_token)}
+    return get_session().get(api_url(path), params=params, headers=headers, timeout=DEFAULT_TIMEOUT)
@@ -0,0 +1,202 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundWriter:
+    """
+    Moves parsing and disk I/O off the thread that reads the stream.
+
+    put() hands an item to a bounded queue and a dedicated thread calls
+    handle(item) for each one, taking up to batch_size items per wake up.
+    flush() is called once flush_lines items were handled since the last
+    flush or flush_interval seconds have passed, so the output is not
+    flushed after every record.
+
+    When the queue is full put() either waits for room (block=True, counted
+    as a stall) or throws the item away (block=False, counted as a drop).
+
+    With a spill log (see spill_log.SpillLog; items must then be bytes),
+    once spill_threshold items are waiting put() appends to the log instead,
+    so it never waits and nothing is dropped. Everything after that goes to
+    the log too, to keep the order, until the writer thread has worked
+    through the queue and the log and caught up.
+
+    stats() reports the queue depth and the counters.
+    """
+
+    def __init__(self, handle, flush, max_queue=10000, block=True, flush_interval=5.0, flush_lines=1000,
+                 batch_size=500, spill=None, spill_threshold=None, name="background-writer"):
+        self.handle = handle
+        self.flush = flush
+        self.block = block
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.batch_size = batch_size
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.spill = spill
+        self.spill_threshold = max_queue // 2 if spill_threshold is None else spill_threshold
+        # leftovers from a previous run are older than anything new
+        self.spilling = spill is not None and len(spill) > 0
+        self._spill_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+        self.enqueued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.errors = 0
+        self.flushes = 0
+        self.max_depth = 0
+
+        self._stopping = False
+        self._finishing = False
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def put(self, item, spill=True, block=None):
+        """
+        Queue an item for the writer thread; returns False if it was dropped.
+        spill=False keeps an item that is not bytes, or whose order does not
+        matter, out of the spill log, and block overrides the writer's policy
+        for a full queue.
+        """
+        if self.spill is not None and spill:
+            with self._spill_lock:
+                if self.spilling or self.queue.qsize() >= self.spill_threshold:
+                    if not self.spilling:
+                        logger.warning("background writer: {} items queued, spilling to disk".format(self.queue.qsize()))
+                    self.spilling = True
+                    self.spill.append(item)
+                    self.spilled += 1
+                    self.enqueued += 1
+                    return True
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if not (self.block if block is None else block):
+                self.dropped += 1
+                return False
+            self.stalls += 1
+            started = time.monotonic()
+            self.queue.put(item)
+            self.stall_time += time.monotonic() - started
+
+        self.enqueued += 1
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def _next_batch(self):
+        if self.spilling and self.queue.empty():
+            return self._spilled_batch()
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval if not self.spilling else 0.1)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _spilled_batch(self):
+        # the queue holds nothing older, so work through the log in order
+        batch = []
+        while len(batch) < self.batch_size:
+            data = self.spill.pop()
+            if data is not None:
+                batch.append(data)
+                continue
+            with self._spill_lock:
+                if len(self.spill) == 0:
+                    self.spilling = False
+                    logger.info("background writer: spill log drained")
+                    break
+        return batch
+
+    def _flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            self.errors += 1
+            logger.error("background writer: flush failed: {}".format(e))
+        self.flushes += 1
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def _run(self):
+        while not self._stopping:
+            for item in self._next_batch():
+                if item is _STOP:
+                    self._finishing = True
+                    continue
+                if self._stopping:
+                    break
+                try:
+                    self.handle(item)
+                except Exception as e:
+                    self.errors += 1
+                    logger.exception("background writer: could not handle an item: {}".format(e))
+                self.handled += 1
+                self._unflushed += 1
+
+            if self._unflushed and (self._unflushed >= self.flush_lines
+                                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+            # after stop() keep going until the queue and the spill log are empty
+            if self._finishing and self.queue.empty() and not self.spilling:
+                self._stopping = True
+
+        if self._unflushed:
+            self._flush()
+        if self.spill is not None:
+            self.spill.flush()
+
+    def stop(self, timeout=None):
+        """
+        Handle everything still queued or spilled, flush and wait for the
+        thread to end. Called from the writer thread itself it only asks the
+        loop to finish; anything left in the spill log is read on the next run.
+        """
+        if threading.current_thread() is self.thread:
+            self._stopping = True
+            return
+        if not self.thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "spill_pending": len(self.spill) if self.spill is not None else 0,
+            "stalls": self.stalls,
+            "stall_time": self.stall_time,
+            "errors": self.errors,
+            "flushes": self.flushes,
+        }
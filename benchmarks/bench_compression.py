@@ -0,0 +1,75 @@
+"""
+Write the same normalized sample tweets with each compression codec and level
+in compression.py, then read them back with compression.open_input. Reports
+write and read throughput (of uncompressed JSONL) and the compression ratio.
+Codecs whose package is not installed are skipped.
+
+python3 benchmarks/bench_compression.py --pages 100
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_pages
+
+import compression
+import serializer
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+SETTINGS = [
+    ("gzip", 9), ("gzip", 6), ("gzip", 1),
+    ("zstd", 3), ("zstd", 1), ("zstd", 10),
+    ("lz4", 0),
+    ("none", None),
+]
+
+
+def run(codec, lines, directory):
+    raw_size = sum(len(line) for line in lines)
+    path = os.path.join(directory, "sample.json" + codec.extension)
+
+    started = time.perf_counter()
+    with codec.open(path, "wb") as f:
+        for line in lines:
+            f.write(line)
+    write_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with compression.open_input(path) as f:
+        count = sum(1 for _ in f)
+    read_time = time.perf_counter() - started
+    assert count == len(lines)
+
+    size = os.path.getsize(path)
+    print("{:<6} {:>5} {:>9.1f} MiB/s write {:>9.1f} MiB/s read {:>7.2f}x ratio {:>8.1f} MiB".format(
+        codec.name, "" if codec.level is None else codec.level,
+        raw_size / write_time / 2 ** 20, raw_size / read_time / 2 ** 20, raw_size / float(size), size / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_compression", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=100, help="number of 100 tweet pages to write")
+    args = parser.parse_args()
+
+    normalizer = TweetNormalizer(FULL_FIELDS, places=True)
+    lines = [serializer.dumps_line(record) for page in make_pages(args.pages) for record in normalizer.normalize_page(page)]
+    print("{} tweets, {:.1f} MiB of JSONL".format(len(lines), sum(len(line) for line in lines) / 2 ** 20))
+
+    directory = tempfile.mkdtemp(prefix="bench_compression_")
+    try:
+        for name, level in SETTINGS:
+            try:
+                run(compression.get_codec(name, level), lines, directory)
+            except ImportError as e:
+                print("{:<6} {:>5} skipped: {}".format(name, level, e))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
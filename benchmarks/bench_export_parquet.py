@@ -0,0 +1,64 @@
+"""
+Export sample tweet files to a Parquet dataset with export_parquet.export and
+report rows/sec, the size of the dataset next to the gzipped JSONL, and the
+peak memory of the process. Run it with a few --pages values to see that peak
+memory follows --batch_size rather than the size of the input.
+
+python3 benchmarks/bench_export_parquet.py --pages 500
+"""
+
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_page
+
+import export_parquet
+from partition_writer import PartitionWriter
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_export_parquet", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=500, help="number of 100 tweet pages to export")
+    parser.add_argument("--days", type=int, default=7, help="number of days the tweets are spread over")
+    parser.add_argument("--batch_size", type=int, default=50000, help="rows converted at a time")
+    args = parser.parse_args()
+
+    source = tempfile.mkdtemp(prefix="bench_export_parquet_json_")
+    output = tempfile.mkdtemp(prefix="bench_export_parquet_")
+    try:
+        normalizer = TweetNormalizer(FULL_FIELDS, places=True)
+        with PartitionWriter(lambda i: os.path.join(source, "sample_{}.json.gz".format(i))) as writer:
+            for seed in range(args.pages):
+                for record in normalizer.normalize_page(make_page(100, seed)):
+                    # every page repeats the same ids, so give each page its own
+                    record["id"] = str(int(record["id"]) + seed * 1000)
+                    record["created_at"] = "2022-10-{:02d}T12:00:00.000Z".format(1 + seed % args.days)
+                    writer.write(record)
+        rows = writer.total
+
+        started = time.perf_counter()
+        export_parquet.export(writer.files, output, args.batch_size)
+        elapsed = time.perf_counter() - started
+
+        print("{} rows in {:.1f}s, {:.0f} rows/s".format(rows, elapsed, rows / elapsed))
+        print("gzipped JSONL {:.1f} MiB, Parquet {:.1f} MiB".format(
+            directory_size(source) / 2 ** 20, directory_size(output) / 2 ** 20))
+        print("peak memory {:.0f} MiB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        shutil.rmtree(source)
+        shutil.rmtree(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Compare a bare requests.get per page against the pooled keep-alive session in
+api_utils, both hitting a local mock endpoint.
+
+python3 benchmarks/bench_http_client.py --requests 2000
+"""
+
+import argparse
+import time
+
+import requests
+
+from mock_api import report, start_server
+
+import api_utils
+
+
+def run(name, get, url, count):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        r = get(url)
+        r.json()
+        latencies.append(time.perf_counter() - t)
+    report(name, latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_http_client", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="number of requests per client")
+    args = parser.parse_args()
+
+    server, base_url = start_server()
+    url = base_url + "/2/tweets/search/all"
+    try:
+        run("requests.get", lambda u: requests.get(u, params={"query": "x"}), url, args.requests)
+
+        session = api_utils.make_session()
+        run("api_utils session", lambda u: session.get(u, params={"query": "x"}), url, args.requests)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
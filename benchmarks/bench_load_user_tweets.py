@@ -0,0 +1,142 @@
+"""
+Load the same sample tweet files into a scratch copy of the user_tweets table
+with load_user_tweets.load (one INSERT per tweet) and load_user_tweets.copy_load
+(COPY into a staging table, then one upsert per batch), then with COPY from
+--workers processes at once through load_user_tweets.main, with and without
+--premerge, and report rows/sec.
+Every file repeats --duplicates of the previous file's tweets, the way
+referenced tweets show up again in later files, so both paths have to merge
+source_files. Needs psycopg2 and a Postgres server the current user can
+create tables in; the scratch table is dropped at the end.
+
+python3 benchmarks/bench_load_user_tweets.py --host localhost --tweets 100000
+"""
+
+import argparse
+import getpass
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_pages
+
+import psycopg2
+
+import compression
+import load_user_tweets
+import serializer
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "load_user_tweets.sql")
+
+
+def write_files(directory, tweets, files, duplicates):
+    normalizer = TweetNormalizer(FULL_FIELDS, places=True)
+    template = [record for page in make_pages(10) for record in normalizer.normalize_page(page)]
+    per_file = tweets // files
+    rnd = random.Random(0)
+    codec = compression.get_codec()
+
+    paths = []
+    next_id = 1580000000000000000
+    previous = []
+    for index in range(files):
+        records = []
+        for i in range(per_file):
+            record = dict(template[i % len(template)])
+            record["id"] = str(next_id)
+            next_id += 1
+            records.append(record)
+        records.extend(rnd.sample(previous, int(len(previous) * duplicates)))
+        path = os.path.join(directory, "sample_{}.json{}".format(index, codec.extension))
+        with codec.open(path, "wb") as f:
+            for record in records:
+                f.write(serializer.dumps_line(record))
+        paths.append(path)
+        previous = records[:per_file]
+    return paths
+
+
+def reset_table(conn, table):
+    with open(SQL) as f:
+        create = f.read().replace("public.user_tweets", table)
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS {}".format(table))
+        cur.execute(create)
+    conn.commit()
+
+
+def summary(conn, table):
+    with conn.cursor() as cur:
+        cur.execute("SELECT count(*), sum(cardinality(source_files)) FROM {}".format(table))
+        return cur.fetchone()
+
+
+def main():
+    username = getpass.getuser()
+    parser = argparse.ArgumentParser(prog="bench_load_user_tweets", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--host", default="localhost", help="the database cluster to load into")
+    parser.add_argument("-d", "--database", default=username, help="the database to load into")
+    parser.add_argument("-u", "--username", default=username, help="the user to connect as")
+    parser.add_argument("--tweets", type=int, default=100000, help="number of distinct tweets to load")
+    parser.add_argument("--files", type=int, default=10, help="number of files to spread them over")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="share of each file repeated in the next one")
+    parser.add_argument("--batch_size", type=int, default=50000, help="rows per COPY batch")
+    parser.add_argument("--workers", type=int, default=4, help="processes for the parallel COPY run")
+    parser.add_argument("--skip-insert", action="store_true", help="only time the COPY path")
+    args = parser.parse_args()
+
+    table = "bench_user_tweets_{}".format(os.getpid())
+    directory = tempfile.mkdtemp(prefix="bench_load_user_tweets_")
+    conn = psycopg2.connect(host=args.host, dbname=args.database, user=args.username)
+    try:
+        paths = write_files(directory, args.tweets, args.files, args.duplicates)
+        rows = 0
+        for path in paths:
+            with compression.open_input(path) as f:
+                rows += sum(1 for _ in f)
+        print("{} rows ({} distinct tweets) in {} files".format(rows, args.tweets, len(paths)))
+
+        results = {}
+
+        def serial(load):
+            for path in paths:
+                load(path)
+
+        runs = [
+            ("copy", lambda: serial(lambda path: load_user_tweets.copy_load(conn, table, path, args.batch_size))),
+            ("copy x{}".format(args.workers), lambda: load_user_tweets.main(
+                input=os.path.join(directory, "*"), host=args.host, database=args.database, username=args.username,
+                table=table, copy=True, batch_size=args.batch_size, workers=args.workers)),
+            ("merged x{}".format(args.workers), lambda: load_user_tweets.main(
+                input=os.path.join(directory, "*"), host=args.host, database=args.database, username=args.username,
+                table=table, copy=True, batch_size=args.batch_size, workers=args.workers, premerge=True)),
+        ]
+        if not args.skip_insert:
+            runs.insert(0, ("insert", lambda: serial(lambda path: load_user_tweets.load(
+                args.host, args.database, args.username, table, path))))
+        for name, run in runs:
+            reset_table(conn, table)
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            results[name] = summary(conn, table)
+            print("{:<9} {:>10.0f} rows/s {:>8.1f}s  {} tweets, {} source files".format(
+                name, rows / elapsed, elapsed, *results[name]))
+
+        if len(set(results.values())) > 1:
+            print("the runs loaded different data: {}".format(results))
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS {}".format(table))
+        conn.commit()
+        conn.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Download media from a local file server with download_utils.MediaDownloader,
+one file at a time and then with --workers threads, and report files/s and
+MiB/s. The URLs are split over two host names (127.0.0.1 and localhost) so
+the per-host limits apply. Each request waits --latency ms before answering.
+Every 10th file fails once with a 503 and is retried, and every 50th is a 404
+that is not retried. Every 7th file is cut off halfway the first time and
+resumed with a Range request. The files on disk are checked against what was
+served, and the bytes sent are compared with the size of the files.
+
+python3 benchmarks/bench_media_download.py --files 200 --workers 8
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from mock_api import MockHandler, start_server
+
+import download_utils
+
+
+class MediaHandler(MockHandler):
+    size = 256 * 1024
+    latency = 0.05
+    failed_once = set()
+    cut_once = set()
+    sent = 0
+    lock = threading.Lock()
+
+    def first_time(self, seen):
+        with self.lock:
+            first = self.path not in seen
+            seen.add(self.path)
+            return first
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        index = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+        if index % 50 == 49:
+            return self.send_body(404, b"error")
+        if index % 10 == 9 and self.first_time(self.failed_once):
+            return self.send_body(503, b"error")
+
+        body = bytes([index % 256]) * self.size
+        start = 0
+        ranged = self.headers.get("Range", "")
+        if ranged.startswith("bytes="):
+            start = int(ranged[len("bytes="):].split("-")[0])
+        if start >= len(body):
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(len(body)))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body) - start))
+        if start:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(body) - 1, len(body)))
+        self.end_headers()
+        if index % 7 == 6 and self.first_time(self.cut_once):
+            # drop the connection halfway through
+            self.write(body[start:start + (len(body) - start) // 2])
+            self.close_connection = True
+            return
+        self.write(body[start:])
+
+    def send_body(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write(self, data):
+        self.wfile.write(data)
+        with self.lock:
+            MediaHandler.sent += len(data)
+
+
+def run(name, urls, downloader):
+    output = tempfile.mkdtemp(prefix="bench_media_download_")
+    try:
+        started = time.perf_counter()
+        counts = downloader.run(urls, output, "image")
+        elapsed = time.perf_counter() - started
+
+        names = os.listdir(output)
+        bad = [f for f in names if f.endswith(".part") or os.path.getsize(os.path.join(output, f)) != MediaHandler.size]
+        print("{:<12} {:>7.1f} files/s {:>8.1f} MiB/s {:>7.1f}s  downloaded {}, failed {}, wrong size {}, "
+              "sent {:.2f}x the file sizes".format(
+                  name, counts["downloaded"] / elapsed, counts["bytes"] / elapsed / 2 ** 20, elapsed,
+                  counts["downloaded"], counts["failed"], len(bad),
+                  MediaHandler.sent / float(max(1, len(names) * MediaHandler.size))))
+    finally:
+        shutil.rmtree(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_media_download", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--files", type=int, default=200, help="number of files to download")
+    parser.add_argument("--size", type=int, default=256, help="size of each file in KiB")
+    parser.add_argument("--latency", type=float, default=50, help="ms before the server answers")
+    parser.add_argument("--workers", type=int, default=8, help="threads for the concurrent run")
+    parser.add_argument("--host_limit", type=int, default=4, help="downloads at once per host name")
+    parser.add_argument("--bandwidth", type=float, help="MiB/s for an extra run with a bandwidth limit")
+    args = parser.parse_args()
+
+    MediaHandler.size = args.size * 1024
+    MediaHandler.latency = args.latency / 1000.0
+    server, base_url = start_server(MediaHandler)
+    port = server.server_address[1]
+    urls = ["http://{}:{}/media/{}.jpg".format("127.0.0.1" if i % 2 else "localhost", port, i) for i in range(args.files)]
+    limits = {"127.0.0.1": args.host_limit, "localhost": args.host_limit}
+
+    try:
+        runs = [
+            ("serial", download_utils.MediaDownloader(1, limits, retry_wait=0)),
+            ("{} workers".format(args.workers), download_utils.MediaDownloader(args.workers, limits, retry_wait=0)),
+        ]
+        if args.bandwidth:
+            runs.append(("{} MiB/s".format(args.bandwidth), download_utils.MediaDownloader(
+                args.workers, limits, bandwidth=args.bandwidth * 2 ** 20, retry_wait=0)))
+        for name, downloader in runs:
+            MediaHandler.failed_once.clear()
+            MediaHandler.cut_once.clear()
+            MediaHandler.sent = 0
+            run(name, urls, downloader)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
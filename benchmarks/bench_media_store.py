@@ -0,0 +1,124 @@
+"""
+Download media from a local file server through a media_store.MediaStore
+and check what it saves. Each of --photos photos is listed under its URL
+twice, under a second URL with the same media key, and under a third URL
+with another media key but the same bytes. The same list is then downloaded
+again into a second output directory. Reports the requests the server
+answered, the download counts, the blobs stored and the bytes the outputs
+take on disk, and checks every output file has the right content.
+
+The run is repeated with the store on another file system (--other_fs,
+/dev/shm by default), where blobs are copied instead of linked.
+
+python3 benchmarks/bench_media_store.py --photos 50
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from mock_api import MockHandler, start_server
+
+import download_utils
+from media_store import MediaStore
+
+
+class PhotoHandler(MockHandler):
+    size = 64 * 1024
+    requests = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            PhotoHandler.requests += 1
+        name = self.path.rsplit("/", 1)[-1].split(".")[0]
+        # p3.jpg, p3_alt.jpg and c3.jpg are the same photo
+        index = int(name.lstrip("pc").split("_")[0])
+        body = index.to_bytes(4, "little") * (self.size // 4)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def disk_usage(directories):
+    inodes = {}
+    for directory in directories:
+        for name in os.listdir(directory):
+            stat = os.stat(os.path.join(directory, name))
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(inodes.values())
+
+
+def check(output, photos):
+    bad = 0
+    for i in range(photos):
+        expected = i.to_bytes(4, "little") * (PhotoHandler.size // 4)
+        for name in ("p{}.jpg", "p{}_alt.jpg", "c{}.jpg"):
+            with open(os.path.join(output, name.format(i)), "rb") as f:
+                bad += f.read() != expected
+    return bad
+
+
+def run(name, store_root, urls, media_keys, photos):
+    outputs = [tempfile.mkdtemp(prefix="bench_media_store_out_") for _ in range(2)]
+    try:
+        store = MediaStore(store_root)
+        for index, output in enumerate(outputs):
+            PhotoHandler.requests = 0
+            downloader = download_utils.MediaDownloader(8, {"127.0.0.1": 8}, retry_wait=0, store=store)
+            started = time.perf_counter()
+            counts = downloader.run(urls, output, "image", media_keys)
+            elapsed = time.perf_counter() - started
+            print("{:<16} run {}: {} requests, downloaded {}, linked {}, duplicates {}, skipped {}, failed {}, "
+                  "wrong content {}, {:.1f}s".format(
+                      name, index + 1, PhotoHandler.requests, counts["downloaded"], counts["linked"],
+                      counts["duplicates"], counts["skipped"], counts["failed"], check(output, photos), elapsed))
+        store.close()
+
+        blobs = sum(len(files) for _, _, files in os.walk(os.path.join(store_root, "blobs")))
+        files = sum(len(os.listdir(output)) for output in outputs)
+        print("{:<16} {} files in the outputs, {} blobs, {:.1f} MiB on disk for {:.1f} MiB of files".format(
+            name, files, blobs, disk_usage(outputs + [os.path.join(store_root, "blobs", d)
+                                                       for d in os.listdir(os.path.join(store_root, "blobs"))]) / 2 ** 20,
+            files * PhotoHandler.size / 2 ** 20))
+    finally:
+        for output in outputs:
+            shutil.rmtree(output)
+        shutil.rmtree(store_root)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_media_store", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--photos", type=int, default=50, help="number of distinct photos")
+    parser.add_argument("--size", type=int, default=64, help="size of each photo in KiB")
+    parser.add_argument("--other_fs", default="/dev/shm", help="a directory on another file system for the store")
+    args = parser.parse_args()
+
+    PhotoHandler.size = args.size * 1024
+    server, base_url = start_server(PhotoHandler)
+    urls, media_keys = [], {}
+    for i in range(args.photos):
+        for name, key in (("p{}.jpg", "k{}"), ("p{}.jpg", "k{}"), ("p{}_alt.jpg", "k{}"), ("c{}.jpg", "other{}")):
+            url = "{}/media/{}".format(base_url, name.format(i))
+            urls.append(url)
+            media_keys[url] = key.format(i)
+
+    try:
+        run("same fs", tempfile.mkdtemp(prefix="bench_media_store_"), urls, media_keys, args.photos)
+        if os.path.isdir(args.other_fs) and os.stat(args.other_fs).st_dev != os.stat(tempfile.gettempdir()).st_dev:
+            run("other fs", tempfile.mkdtemp(prefix="bench_media_store_", dir=args.other_fs), urls, media_keys,
+                args.photos)
+        else:
+            print("{} is not on another file system, skipping that run".format(args.other_fs))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Extract the media URLs of a directory of sample tweet files with
+download_media2.parse_media_urls and, for comparison, with the pandas code it
+replaced (a DataFrame per file, exploded and concatenated before removing
+duplicates). Reports tweets/s, the number of distinct URLs and the peak memory
+traced while extracting. The comparison needs pandas, which the scripts no
+longer use; leave it out with --skip_pandas.
+
+python3 benchmarks/bench_media_urls.py --pages 500
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_page
+
+import compression
+import download_media2
+from partition_writer import PartitionWriter
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+
+def pandas_media_urls(input, func):
+    import pandas as pd
+
+    results = []
+    for file in os.listdir(input):
+        if not compression.is_data_file(file):
+            continue
+        with compression.open_input(os.path.join(input, file)) as f:
+            df = pd.read_json(f, lines=True)
+        df = df[~df['media_objects'].isnull()]
+        df['urls'] = df['media_objects'].apply(func)
+        df = df[~df['urls'].isnull()]
+        results.append(df[['urls']].explode('urls'))
+    df = pd.concat(results, axis=0)
+    df.drop_duplicates(inplace=True)
+    return df['urls'].to_list()
+
+
+def run(name, tweets, extract):
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = extract()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{:<10} {:>9.0f} tweets/s {:>7.1f}s  {} urls, peak {:.1f} MiB".format(
+        name, tweets / elapsed, elapsed, count, peak / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_media_urls", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=500, help="number of 100 tweet pages to write")
+    parser.add_argument("--skip_pandas", action="store_true", help="only run parse_media_urls")
+    args = parser.parse_args()
+
+    source = tempfile.mkdtemp(prefix="bench_media_urls_")
+    try:
+        normalizer = TweetNormalizer(FULL_FIELDS, places=True)
+        with PartitionWriter(lambda i: os.path.join(source, "sample_{}.json.gz".format(i))) as writer:
+            for seed in range(args.pages):
+                writer.write_all(normalizer.normalize_page(make_page(100, seed)))
+        tweets = writer.total
+
+        types = ["image", "video"]
+        extractors = download_media2.make_extractors("both")
+        run("streaming", tweets, lambda: sum(len(urls) for urls in download_media2.parse_media_urls(source, extractors).values()))
+        if not args.skip_pandas:
+            run("pandas", tweets, lambda: sum(len(pandas_media_urls(source, download_media2.EXTRACTORS[t])) for t in types))
+    finally:
+        shutil.rmtree(source)
+
+
+if __name__ == "__main__":
+    main()
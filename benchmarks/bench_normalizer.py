@@ -0,0 +1,195 @@
+"""
+Compare the per-script parse_tweet that search2.py used to carry (kept below
+as the baseline) with the compiled TweetNormalizer, on tweepy Response
+objects and on raw JSON pages.
+
+python3 benchmarks/bench_normalizer.py --pages 200
+"""
+
+import argparse
+import time
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_pages, to_tweepy_response
+
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+
+# ---- baseline, as it was in search2.py ----
+
+def get_hashtags(entities):
+    if not entities:
+        return
+
+    hashtags = entities.get('hashtags')
+    if not hashtags:
+        return
+
+    hlst = []
+    for h in hashtags:
+        hlst.append(h['tag'])
+
+    return hlst
+
+
+def get_expanded_urls(entities):
+    if not entities:
+        return
+
+    urls = entities.get('urls')
+    if not urls:
+        return
+
+    ulst = []
+    for h in urls:
+        ulst.append(h['expanded_url'])
+
+    return ulst
+
+
+def get_media_view_count(media):
+    if 'public_metrics' not in media:
+        return
+    return media.get("public_metrics").get("view_count", None)
+
+
+def parse_ref_tweet(tweet, users):
+    obj = {
+        "id": tweet["id"],
+        "conversation_id": tweet["conversation_id"],
+        "created_at": tweet["created_at"],
+        "tweet": tweet["text"],
+        "hashtags": get_hashtags(tweet.get('entities')),
+        "urls": get_expanded_urls(tweet.get('entities')),
+        "source": tweet.get("source", None),
+        "language": tweet["lang"],
+        "retweet_count": tweet["public_metrics"]["retweet_count"],
+        "reply_count": tweet["public_metrics"]["reply_count"],
+        "like_count": tweet["public_metrics"]["like_count"],
+        "quote_count": tweet["public_metrics"]["quote_count"],
+        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
+        "possibly_sensitive": tweet["possibly_sensitive"],
+        "reply_settings": tweet["reply_settings"],
+    }
+
+    author = users.get(tweet["author_id"])  # get user object
+    if author:
+        obj.update({
+            "user_id": tweet["author_id"],
+            "user_screen_name": author["username"],
+            "user_name": author["name"],
+            "user_description": author["description"],
+            "user_location": author.get("location"),
+            "user_created_at": author["created_at"],
+            "user_followers_count": author["public_metrics"]["followers_count"],
+            "user_friends_count": author["public_metrics"]["following_count"],
+            "user_statuses_count": author["public_metrics"]["tweet_count"],
+            "user_verified": author["verified"]
+        })
+    return obj
+
+
+def parse_tweet(tweet, users, **kwargs):
+    author = users.get(tweet["author_id"])  # get user object
+    obj = {
+        "id": tweet["id"],
+        "conversation_id": tweet["conversation_id"],
+        "created_at": tweet["created_at"],
+        "tweet": tweet["text"],
+        "entities": tweet.entities,
+        "hashtags": get_hashtags(tweet.get('entities')),
+        "urls": get_expanded_urls(tweet.get('entities')),
+        "source": tweet.get("source", None),
+        "language": tweet["lang"],
+        "retweet_count": tweet["public_metrics"]["retweet_count"],
+        "reply_count": tweet["public_metrics"]["reply_count"],
+        "like_count": tweet["public_metrics"]["like_count"],
+        "quote_count": tweet["public_metrics"]["quote_count"],
+        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
+        "possibly_sensitive": tweet["possibly_sensitive"],
+        "reply_settings": tweet["reply_settings"],
+
+        "user_id": tweet["author_id"],
+        "user_screen_name": author["username"],
+        "user_name": author["name"],
+        "user_description": author["description"],
+        "user_location": author.get("location"),
+        "user_created_at": author["created_at"],
+        "user_followers_count": author["public_metrics"]["followers_count"],
+        "user_friends_count": author["public_metrics"]["following_count"],
+        "user_statuses_count": author["public_metrics"]["tweet_count"],
+        "user_verified": author["verified"],
+
+        "references": tweet.get("referenced_tweets"),
+        "context_annotations": tweet.get("context_annotations", None),
+    }
+
+    if kwargs['includes_tweets']:
+        includes_tweets = kwargs['includes_tweets']
+        if tweet['referenced_tweets']:
+            ref_tweets = tweet.get("referenced_tweets")
+            for ref_tweet_dict in ref_tweets:
+                if ref_tweet_dict['id'] in includes_tweets:
+                    ref_tweet_obj = parse_ref_tweet(includes_tweets[ref_tweet_dict['id']], users)
+                    type = ref_tweet_dict['type']
+                    obj['references_%s'%type] = ref_tweet_obj
+
+    if kwargs['includes_media']:
+        includes_media = kwargs['includes_media']
+        if "attachments" in tweet and "media_keys" in tweet['attachments']:
+            media_keys = tweet['attachments']['media_keys']
+            mobjs = []
+            for media_key in media_keys:
+                media = includes_media.get(media_key)
+                if not media:
+                    continue
+                mobj = {
+                    "media_key": media["media_key"],
+                    "media_type": media["type"],
+                    "media_view_count": get_media_view_count(media),
+                    "media_height": media.get("height"),
+                    "media_width": media.get("width"),
+                    "media_url": media.get("url"),
+                    "media_preview_image_url": media.get("preview_image_url"),
+                    "media_variants":media.get("variants"),
+                    "media_alt_text": media.get("alt_text")
+                }
+                mobjs.append(mobj)
+            obj['media_objects'] = mobjs
+    return obj
+
+
+def baseline_page(resp):
+    users = {u["id"]: u for u in resp.includes['users']}
+    includes_tweets = {t.id: t for t in resp.includes.get('tweets', [])}
+    includes_media = {m['media_key']: m for m in resp.includes.get('media', [])}
+    return [parse_tweet(tweet, users, includes_tweets=includes_tweets, includes_media=includes_media)
+            for tweet in resp.data]
+
+
+def run(name, parse, pages):
+    count = 0
+    started = time.perf_counter()
+    for page in pages:
+        count += len(parse(page))
+    elapsed = time.perf_counter() - started
+    print("{:<32} {:>8} tweets {:>8.3f}s {:>10.0f} tweets/s".format(name, count, elapsed, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_normalizer", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200, help="number of 100 tweet pages to parse")
+    args = parser.parse_args()
+
+    raw_pages = make_pages(args.pages)
+    tweepy_pages = [to_tweepy_response(page) for page in raw_pages]
+    normalizer = TweetNormalizer(FULL_FIELDS)
+
+    run("baseline parse_tweet (tweepy)", baseline_page, tweepy_pages)
+    run("TweetNormalizer (tweepy)", normalizer.normalize_page, tweepy_pages)
+    run("TweetNormalizer (raw dict)", normalizer.normalize_page, raw_pages)
+
+
+if __name__ == "__main__":
+    main()
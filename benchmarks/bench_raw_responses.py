@@ -0,0 +1,71 @@
+"""
+Compare the tweepy model path with the raw JSON path ("raw_responses": true)
+from response body to output lines: decode the body, build tweepy models (or
+not), normalize the page and serialize every record. Reports throughput and
+the peak memory allocated per page.
+
+python3 benchmarks/bench_raw_responses.py --pages 200
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_pages
+
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+
+def tweepy_path(normalizer):
+    import tweepy
+    client = tweepy.Client("unused")
+
+    def process(body):
+        resp = client._construct_response(json.loads(body), tweepy.Tweet)
+        return [json.dumps(obj, default=str, ensure_ascii=False) for obj in normalizer.normalize_page(resp)]
+    return process
+
+
+def raw_path(normalizer):
+    def process(body):
+        resp = json.loads(body)
+        return [json.dumps(obj, default=str, ensure_ascii=False) for obj in normalizer.normalize_page(resp)]
+    return process
+
+
+def run(name, process, bodies):
+    count = 0
+    started = time.perf_counter()
+    for body in bodies:
+        count += len(process(body))
+    elapsed = time.perf_counter() - started
+
+    # measured separately so tracing does not slow down the timing run
+    peaks = []
+    for body in bodies[:20]:
+        tracemalloc.start()
+        process(body)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    print("{:<20} {:>8} tweets {:>8.3f}s {:>10.0f} tweets/s {:>8.0f} KiB peak/page".format(
+        name, count, elapsed, count / elapsed, max(peaks) / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_raw_responses", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200, help="number of 100 tweet pages to process")
+    args = parser.parse_args()
+
+    bodies = [json.dumps(page).encode("utf-8") for page in make_pages(args.pages)]
+    normalizer = TweetNormalizer(FULL_FIELDS)
+
+    run("tweepy models", tweepy_path(normalizer), bodies)
+    run("raw JSON", raw_path(normalizer), bodies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compare the json.dumps calls the writers used to make per line with each
+backend in serializer.py, on normalized records built from real-shaped pages.
+created_at and user_created_at are datetimes in the pages, as they are when
+tweepy builds the models, and the old calls get records that still hold them.
+
+The default backend has to produce identical bytes to both old calls:
+json.dumps(default=str) (stream.py, hydrate.py, search.py, the reply and
+user tweet scripts) and json.dumps(default=str, ensure_ascii=False) (the
+partition files). The script exits with an error if it does not. Other
+backends are checked for decoding to the same objects.
+
+python3 benchmarks/bench_serializer.py --pages 200
+"""
+
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+
+import mock_api  # noqa: F401, puts the repo root on sys.path
+from sample_tweets import make_pages
+
+import serializer
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def with_datetimes(page):
+    # what tweepy hands the normalizer: created_at parsed into datetimes
+    for item in page["data"] + page.get("includes", {}).get("tweets", []) + page.get("includes", {}).get("users", []):
+        if "created_at" in item:
+            item["created_at"] = parse_time(item["created_at"])
+    return page
+
+
+def old_record(record):
+    # the normalizer used to pass the datetimes through to the writers
+    old = dict(record)
+    for item in [old] + [v for k, v in old.items() if k.startswith("references_")]:
+        for key in ("created_at", "user_created_at"):
+            if isinstance(item.get(key), str):
+                item[key] = datetime.fromisoformat(item[key])
+    return old
+
+
+def run(name, dumps_line, records):
+    started = time.perf_counter()
+    lines = [dumps_line(record) for record in records]
+    elapsed = time.perf_counter() - started
+    size = sum(len(line) for line in lines)
+    print("{:<32} {:>8} tweets {:>8.3f}s {:>10.0f} tweets/s {:>8.1f} MiB".format(
+        name, len(lines), elapsed, len(lines) / elapsed, size / 1024.0 / 1024.0))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_serializer", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200, help="number of 100 tweet pages to serialize")
+    args = parser.parse_args()
+
+    normalizer = TweetNormalizer(FULL_FIELDS)
+    records = [record for page in make_pages(args.pages) for record in normalizer.normalize_page(with_datetimes(page))]
+    old_records = [old_record(record) for record in records]
+
+    baselines = {
+        True: run("json.dumps(default=str)", lambda r: (json.dumps(r, default=str) + "\n").encode("utf-8"),
+                  old_records),
+        False: run("json.dumps(ensure_ascii=False)",
+                   lambda r: (json.dumps(r, default=str, ensure_ascii=False) + "\n").encode("utf-8"), old_records),
+    }
+
+    failed = False
+    for name in serializer.BACKENDS:
+        try:
+            backend = serializer.get_backend(name)
+        except ImportError:
+            print("{:<32} not installed".format(name))
+            continue
+        for ensure_ascii, baseline in baselines.items():
+            label = "{} ensure_ascii={}".format(name, ensure_ascii)
+            lines = run(label, lambda r: backend.dumps_line(r, ensure_ascii), records)
+            if lines == baseline:
+                result = "identical bytes"
+            else:
+                different = sum(json.loads(line) != json.loads(old) for line, old in zip(lines, baseline))
+                result = "same objects, different bytes" if not different else "DIFFERENT objects on {} lines".format(different)
+                failed = failed or different or name == serializer.DEFAULT_BACKEND
+            print("{:<32} {}".format("", result))
+
+    if failed:
+        sys.exit("the default backend must write identical bytes, and every backend the same objects")
+
+
+if __name__ == "__main__":
+    main()
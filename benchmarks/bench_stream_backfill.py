@@ -0,0 +1,173 @@
+"""
+Run TwitterStreamer against a local stand-in for the filtered stream and the
+full archive search. The stand-in drops the stream connection every
+--disconnect-every tweets and keeps the next --gap tweets to itself, so they
+can only be found by the backfill search. At the end the output files are
+checked for missing and duplicated tweet ids, the backfilled records for the
+same keys as the streamed ones, and the state file for the newest tweet on
+disk, which is where a restart starts its backfill.
+
+python3 benchmarks/bench_stream_backfill.py --tweets 500
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlparse
+
+from mock_api import MockHandler, start_server
+from sample_tweets import make_tweet, make_user
+
+import api_utils
+import stream
+
+
+class StandIn:
+    """The tweets "posted" while the stand-in runs, for the stream and the search to serve."""
+
+    def __init__(self, total, disconnect_every, gap):
+        self.total = total
+        self.disconnect_every = disconnect_every
+        self.gap = gap
+        self.users = [make_user(i) for i in range(10)]
+        self.created = []  # every tweet, in the order it was created
+        self.streamed = set()  # the ids sent on the stream, the others can only come from the backfill
+        self.places = [{"id": "01a9a39529b27f36", "full_name": "Manhattan, NY", "country": "United States",
+                        "country_code": "US", "name": "Manhattan", "place_type": "city"}]
+        self.lock = threading.Lock()
+
+    def create(self):
+        with self.lock:
+            i = len(self.created)
+            if i >= self.total:
+                return None
+            tweet = make_tweet(i, self.users[i % 10], place_id=self.places[0]["id"])
+            tweet["created_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            tweet.pop("context_annotations")
+            self.created.append(tweet)
+            return tweet
+
+    def page(self, tweets):
+        return {"data": tweets, "includes": {"users": self.users, "places": self.places}, "meta": {"result_count": len(tweets)}}
+
+    def search(self, start_time, end_time):
+        # newest first, like the full archive search
+        start, end = start_time[:19], end_time[:19]
+        with self.lock:
+            return [t for t in reversed(self.created) if start <= t["created_at"][:19] < end]
+
+
+def make_handler(stand_in):
+    class StreamHandler(MockHandler):
+        def send_json(self, obj, status=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("x-rate-limit-remaining", "300")
+            self.send_header("x-rate-limit-reset", str(int(time.time()) + 900))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_json({"data": [{"id": "1", "value": "stand-in"}],
+                            "meta": {"sent": "", "summary": {"created": 1, "valid": 1}}})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path.endswith("/search/stream"):
+                return self.stream()
+            if url.path.endswith("/search/all"):
+                return self.send_json(stand_in.page(stand_in.search(params["start_time"], params["end_time"])))
+            self.send_json({"data": [], "meta": {"result_count": 0}})
+
+        def stream(self):
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            sent = 0
+            while True:
+                if sent >= stand_in.disconnect_every:
+                    # drop the connection; the next tweets are sent while nobody is listening
+                    for _ in range(stand_in.gap):
+                        stand_in.create()
+                        time.sleep(0.01)
+                    return
+                tweet = stand_in.create()
+                line = b"\r\n" if tweet is None else json.dumps(stand_in.page(tweet)).encode("utf-8") + b"\r\n"
+                try:
+                    self.wfile.write(line)
+                    self.wfile.flush()
+                except OSError:
+                    return
+                if tweet is not None:
+                    sent += 1
+                    stand_in.streamed.add(tweet["id"])
+                time.sleep(0.01 if tweet is not None else 0.5)
+
+    return StreamHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_stream_backfill", description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--tweets", type=int, default=500, help="number of tweets the stand-in creates")
+    parser.add_argument("--disconnect-every", type=int, default=150, help="tweets sent per connection")
+    parser.add_argument("--gap", type=int, default=40, help="tweets created while disconnected")
+    args = parser.parse_args()
+
+    stand_in = StandIn(args.tweets, args.disconnect_every, args.gap)
+    server, base_url = start_server(make_handler(stand_in))
+    # the streamer and the backfill search both go through api_utils.APISession
+    api_utils.API_BASE_URL = base_url
+    stream.SEARCH_LAG = 0
+    stream.BACKFILL_DELAY = 2
+
+    output = tempfile.mkdtemp(prefix="bench_stream_backfill_")
+    try:
+        query = {"name": "stand_in", "query": "stand-in", "max_results": 500, "raw_responses": True}
+        backfill = stream.make_backfill({"bearer_token": "unused"}, query, "created_at", "username", "author_id",
+                                        None, None)
+        streamer = stream.TwitterStreamer("unused", args.tweets, output, raw=True, backfill=backfill,
+                                          writer_options={"flush_interval": 0.5, "flush_lines": 50})
+        started = time.perf_counter()
+        streamer.filter(tweet_fields="created_at", expansions="author_id")
+        streamer.on_exit()
+        elapsed = time.perf_counter() - started
+
+        ids = []
+        keys = {True: set(), False: set()}  # the key sets of the streamed and of the backfilled records
+        for name in os.listdir(output):
+            if name.startswith("data-") and ".tmp" not in name:
+                with stream.compression.open_input(os.path.join(output, name)) as f:
+                    for line in f:
+                        record = json.loads(line)
+                        ids.append(record["id"])
+                        keys[record["id"] in stand_in.streamed].add(tuple(sorted(record)))
+        created = {t["id"] for t in stand_in.created}
+        print("created {} tweets, wrote {} ({} unique) in {:.1f}s".format(len(created), len(ids), len(set(ids)), elapsed))
+        print("missing: {}, duplicates: {}, duplicates skipped by the streamer: {}".format(
+            len(created - set(ids)), len(ids) - len(set(ids)), streamer.duplicates))
+        print("backfilled records have the same keys as the streamed ones: {}".format(
+            "yes" if keys[True] == keys[False] else "no, only in one of them: {}".format(
+                sorted(set().union(*keys[False]) ^ set().union(*keys[True])))))
+        with open(os.path.join(output, stream.STATE_FILE), "rt") as f:
+            state = json.load(f)
+        newest = max(ids, key=int)
+        print("state file last_id: {}, newest on disk: {}{}".format(
+            state["last_id"], newest, "" if str(state["last_id"]) == newest else " (a restart would backfill again)"))
+    finally:
+        server.shutdown()
+        shutil.rmtree(output)
+
+
+if __name__ == "__main__":
+    main()
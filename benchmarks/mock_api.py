@@ -0,0 +1,84 @@
+"""
+A tiny stand-in for the Twitter APIv2 used by the benchmarks. It answers every
+GET with a canned JSON page plus the rate limit headers the scripts look at.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# let the benchmarks import the scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def sample_page(n=100):
+    users = [{
+        "id": str(1000 + i),
+        "username": "user{}".format(i),
+        "name": "User {}".format(i),
+        "description": "a sample account",
+        "location": "Seattle, WA",
+        "created_at": "2012-01-01T00:00:00.000Z",
+        "verified": False,
+        "public_metrics": {"followers_count": 10, "following_count": 20, "tweet_count": 30, "listed_count": 0},
+    } for i in range(10)]
+
+    tweets = [{
+        "id": str(1500000000000000000 + i),
+        "conversation_id": str(1500000000000000000 + i),
+        "created_at": "2022-10-01T12:00:00.000Z",
+        "author_id": str(1000 + i % 10),
+        "text": "this is tweet number {} #sample https://t.co/abc".format(i),
+        "lang": "en",
+        "source": "Twitter Web App",
+        "possibly_sensitive": False,
+        "reply_settings": "everyone",
+        "entities": {
+            "hashtags": [{"start": 22, "end": 29, "tag": "sample"}],
+            "urls": [{"start": 30, "end": 47, "url": "https://t.co/abc", "expanded_url": "https://example.com/{}".format(i)}],
+        },
+        "public_metrics": {"retweet_count": i, "reply_count": 1, "like_count": 2, "quote_count": 3},
+    } for i in range(n)]
+
+    return {"data": tweets, "includes": {"users": users}, "meta": {"result_count": n}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections open between requests
+    disable_nagle_algorithm = True
+    body = json.dumps(sample_page()).encode("utf-8")
+    remaining = 300
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.send_header("x-rate-limit-remaining", str(self.remaining))
+        self.send_header("x-rate-limit-reset", str(int(time.time()) + 900))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(handler=MockHandler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def report(name, latencies, elapsed):
+    print("{:<24} {:>10.1f} req/s   p50 {:>7.2f} ms   p99 {:>7.2f} ms".format(
+        name, len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
@@ -0,0 +1,100 @@
+"""
+Real-shaped APIv2 response pages for the benchmarks: tweets with entities,
+metrics, referenced tweets, media and places, plus the matching includes.
+"""
+
+import copy
+import random
+
+
+def make_user(i):
+    return {
+        "id": str(2000000 + i),
+        "username": "user_{}".format(i),
+        "name": "Sample User {} ✨".format(i),
+        "description": "researcher, writer, occasional poster of photos of my cat #{}".format(i),
+        "location": "Seattle, WA",
+        "created_at": "2012-03-0{}T17:42:10.000Z".format(i % 9 + 1),
+        "verified": i % 7 == 0,
+        "protected": False,
+        "url": "https://t.co/{}".format(i),
+        "public_metrics": {"followers_count": 120 * i, "following_count": 300 + i, "tweet_count": 9000 + i, "listed_count": 3},
+    }
+
+
+def make_tweet(i, author, referenced=None, media_keys=None, place_id=None):
+    tweet = {
+        "id": str(1580000000000000000 + i),
+        "conversation_id": str(1580000000000000000 + i),
+        "created_at": "2022-10-{:02d}T{:02d}:{:02d}:{:02d}.000Z".format(i % 28 + 1, i % 24, i % 60, (i * 7) % 60),
+        "author_id": author["id"],
+        "text": "Tweet {} about the #seattle weather and the #seahawks game, more at https://t.co/x{} – über café".format(i, i),
+        "lang": "en",
+        "source": "Twitter for iPhone",
+        "possibly_sensitive": False,
+        "reply_settings": "everyone",
+        "edit_history_tweet_ids": [str(1580000000000000000 + i)],
+        "entities": {
+            "hashtags": [{"start": 24, "end": 32, "tag": "seattle"}, {"start": 53, "end": 62, "tag": "seahawks"}],
+            "urls": [{"start": 76, "end": 99, "url": "https://t.co/x{}".format(i),
+                      "expanded_url": "https://example.com/articles/{}".format(i), "display_url": "example.com/articles/…"}],
+            "mentions": [{"start": 0, "end": 8, "username": "user_1", "id": "2000001"}],
+        },
+        "public_metrics": {"retweet_count": i % 50, "reply_count": i % 5, "like_count": i % 300, "quote_count": i % 3},
+        "context_annotations": [{"domain": {"id": "6", "name": "Sports Event"}, "entity": {"id": "1", "name": "NFL"}}],
+    }
+    if referenced:
+        tweet["referenced_tweets"] = referenced
+    if media_keys:
+        tweet["attachments"] = {"media_keys": media_keys}
+    if place_id:
+        tweet["geo"] = {"place_id": place_id}
+    return tweet
+
+
+def make_page(n=100, seed=0):
+    rnd = random.Random(seed)
+    users = [make_user(i) for i in range(40)]
+    includes_tweets = [make_tweet(100000 + i, users[i % 40]) for i in range(n // 2)]
+    media = []
+    tweets = []
+    for i in range(n):
+        referenced = None
+        if rnd.random() < 0.5:
+            ref = includes_tweets[rnd.randrange(len(includes_tweets))]
+            referenced = [{"type": rnd.choice(["retweeted", "quoted", "replied_to"]), "id": ref["id"]}]
+        media_keys = None
+        if rnd.random() < 0.3:
+            key = "3_{}".format(i)
+            media_keys = [key]
+            if i % 2:
+                media.append({"media_key": key, "type": "photo", "url": "https://pbs.twimg.com/media/F{}.jpg".format(i),
+                              "height": 1080, "width": 1920, "alt_text": "a photo"})
+            else:
+                media.append({"media_key": key, "type": "video", "preview_image_url": "https://pbs.twimg.com/p/{}.jpg".format(i),
+                              "height": 720, "width": 1280, "duration_ms": 30000, "public_metrics": {"view_count": 1000 + i},
+                              "variants": [
+                                  {"bit_rate": 2176000, "content_type": "video/mp4", "url": "https://video.twimg.com/v/{}/vid/1280x720/a.mp4?tag=12".format(i)},
+                                  {"bit_rate": 832000, "content_type": "video/mp4", "url": "https://video.twimg.com/v/{}/vid/640x360/b.mp4?tag=12".format(i)},
+                                  {"bit_rate": 256000, "content_type": "video/mp4", "url": "https://video.twimg.com/v/{}/vid/480x270/c.mp4?tag=12".format(i)},
+                                  {"content_type": "application/x-mpegURL", "url": "https://video.twimg.com/v/{}/pl/list.m3u8?tag=12".format(i)},
+                              ]})
+        place_id = "01a9a39529b27f36" if i % 10 == 0 else None
+        tweets.append(make_tweet(i, users[rnd.randrange(40)], referenced, media_keys, place_id))
+    places = [{"id": "01a9a39529b27f36", "full_name": "Manhattan, NY", "country": "United States", "country_code": "US",
+               "name": "Manhattan", "place_type": "city", "geo": {"type": "Feature", "bbox": [-74.02, 40.69, -73.9, 40.88]}}]
+    return {
+        "data": tweets,
+        "includes": {"users": users, "tweets": includes_tweets, "media": media, "places": places},
+        "meta": {"result_count": n, "next_token": "b26v89c19zqg8o3fpzbkk"},
+    }
+
+
+def make_pages(count, n=100):
+    return [copy.deepcopy(make_page(n, seed)) for seed in range(count)]
+
+
+def to_tweepy_response(page):
+    import tweepy
+    client = tweepy.Client("unused")
+    return client._construct_response(copy.deepcopy(page), tweepy.Tweet)
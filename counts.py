@@ -8,14 +8,19 @@ import argparse
 import json
 import logging
 import os
-import requests
 import sys
 import time
 import traceback
 from glob import glob
 
+from api_utils import add_pool_size_argument, api_get, configure_session
+from rate_limit import RateLimitGovernor
+
 logger = logging.getLogger(__name__)
 
+# the full archive counts allow at most one request per second
+governor = RateLimitGovernor(min_interval=1.0)
+
 
 
 def fetch(bearer_token, query, starting, stopping, granularity, next_token=None):
@@ -39,8 +44,9 @@ def fetch(bearer_token, query, starting, stopping, granularity, next_token=None)
         if next_token is not None:
             params["next_token"] = next_token
 
-        headers = {"Authorization": "Bearer {}".format(bearer_token)}
-        r = requests.get("https://api.twitter.com/2/tweets/counts/all", params=params, headers=headers)
+        governor.acquire()
+        r = api_get(bearer_token, "/2/tweets/counts/all", params)
+        governor.update(r.headers, r.status_code)
 
         if r.status_code >= 500:
             logger.error("received internal server error ({}) from Twitter API".format(r.status_code))
@@ -61,11 +67,9 @@ def fetch(bearer_token, query, starting, stopping, granularity, next_token=None)
             return
 
         if r.status_code == 429:
-            logger.error("reached rate limit, sleeping for {} seconds".format(seconds_remaining))
-            time.sleep(seconds_remaining + 1)
+            # the governor holds the next request until the window resets
+            logger.error("reached rate limit, waiting {} seconds for the window to reset".format(seconds_remaining))
             return
-        else:
-            time.sleep(1)
 
         return r.json()
     except json.decoder.JSONDecodeError as e:
@@ -89,6 +93,8 @@ def main(**kwargs):
         if bearer_token is None:
             raise RuntimeError("could not load bearer token from credentials.json")
 
+    configure_session(pool_maxsize=kwargs.get("pool_size"))
+
     print("starting, stopping, tweet_count")
     pages = 0
     total = 0
@@ -123,6 +129,7 @@ if __name__ == "__main__":
     parser.add_argument("--starting", help="the time to start the search (YYYY-MM-DDTHH:mm:ssZ) (optional)")
     parser.add_argument("--stopping", help="the time to stop the search (YYYY-MM-DDTHH:mm:ssZ) (optional)")
     parser.add_argument("--granularity", choices=("day", "hour", "minute"), default="day", help="how granular to make the results (optional)")
+    add_pool_size_argument(parser)
     args = parser.parse_args()
 
     # configure a basic logger
@@ -1,6 +1,8 @@
 import os
 import argparse
+import metrics
 from download_utils import batch_download, set_proxies
+from media_store import MediaStore
 import time
 
 import logging
@@ -33,6 +35,14 @@ def main():
     parser.add_argument("type", help="url type: 1) image or 2) video")
     parser.add_argument("output", help="output directory to store the output files")
     parser.add_argument("-c", "--cron", action="store_true",help="periodically loop through the input directory and fetch new images or videos")
+    parser.add_argument("--workers", type=int, default=8, help="number of files to download at the same time")
+    parser.add_argument("--host_delay", type=float, default=0.25, help="seconds between starting two downloads from the same host")
+    parser.add_argument("--bandwidth", type=float, help="most MB per second to download, over all hosts together")
+    parser.add_argument("--store", help="keep each distinct file once in this directory and hard link it into OUTPUT;\n"
+                                          "URLs it already has are not downloaded again")
+    parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics_file", help="append a JSON metrics snapshot to this file every --metrics_interval seconds")
+    parser.add_argument("--metrics_interval", type=float, default=60.0, help="seconds between metrics snapshots")
 
     args = parser.parse_args()
 
@@ -43,12 +53,17 @@ def main():
         os.makedirs(output)
 
     print('args: input=%s, input_type=%s, output=%s' % (input, input_type, output))
+    metrics.start(args.metrics_port, args.metrics_file, args.metrics_interval)
 
     #set proxies servers; only works if running on CIP infrastructure
     set_proxies()
 
+    options = {"sleep_time": args.host_delay, "workers": args.workers,
+               "bandwidth": args.bandwidth * 1024 * 1024 if args.bandwidth else None}
+    if args.store:
+        options["store"] = MediaStore(args.store)
     urls = read_urls(input)
-    batch_download(urls, output, input_type)
+    batch_download(urls, output, input_type, **options)
     return
 
 if __name__ == '__main__':
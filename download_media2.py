@@ -1,10 +1,16 @@
 import os
 import argparse
+import hashlib
+import json
+import re
 import traceback
+from functools import partial
 
-import pandas as pd
-
-from download_utils import batch_download, set_proxies
+import compression
+import metrics
+from download_utils import MediaDownloader, batch_download, set_proxies
+from media_manifest import FileManifest
+from media_store import MediaStore
 import time
 
 import logging
@@ -29,13 +35,49 @@ def get_images(media):
     if results:
         return results
 
-def get_videos(media):
+# which renditions of a video to download: every variant, the mp4 with the highest or lowest bit_rate,
+# the mp4 closest to a target resolution, or every mp4 (leaving out the .m3u8 playlist)
+VARIANT_POLICIES = ['all', 'highest', 'lowest', 'closest', 'mp4']
+
+def variant_resolution(variant):
+    # variants only have a url, content_type and bit_rate; the size is in the path: .../vid/1280x720/x.mp4
+    match = re.search(r'/(\d+)x(\d+)/', variant.get('url', ''))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def parse_resolution(resolution):
+    # "1280x720"
+    width, height = resolution.lower().split('x')
+    return int(width), int(height)
+
+def select_variants(variants, policy='all', resolution=None):
+    """The variants of one video to download under policy; resolution is (width, height) for 'closest'."""
+    if policy == 'all':
+        return variants
+    mp4 = [v for v in variants if v.get('content_type') == 'video/mp4' and 'url' in v]
+    if policy == 'mp4' or not mp4:
+        # nothing to choose from: keep what there is rather than lose the video
+        return mp4 or variants
+    if policy == 'highest':
+        return [max(mp4, key=lambda v: v.get('bit_rate', 0))]
+    if policy == 'lowest':
+        return [min(mp4, key=lambda v: v.get('bit_rate', 0))]
+    if policy == 'closest':
+        target = resolution[0] * resolution[1]
+
+        def distance(v):
+            size = variant_resolution(v)
+            # variants without a size in their url go last, then the higher bit rate wins a tie
+            return (abs(size[0] * size[1] - target) if size else float('inf'), -v.get('bit_rate', 0))
+        return [min(mp4, key=distance)]
+    raise ValueError("unknown variant policy: %s" % policy)
+
+def get_videos(media, variants='all', resolution=None):
     if not media or isinstance(media, float):
         return
     results = []
     for m in media:
         if m['media_type'] == 'video' and 'media_variants' in m:
-            media_variants = m['media_variants']
+            media_variants = select_variants(m['media_variants'], variants, resolution)
             for subm in media_variants:
                 if 'url' in subm:
                     results.append(subm['url'])
@@ -43,43 +85,193 @@ def get_videos(media):
         return results
     return
 
-def parse_media_urls(input, func):
-    results = []
+EXTRACTORS = {'image': get_images, 'video': get_videos}
+
+def media_keys(media):
+    """{url: key} for the media of a tweet; a video variant's key adds its bit rate (or type) to the media key."""
+    keys = {}
+    for m in media or ():
+        if 'media_key' not in m:
+            continue
+        if 'media_url' in m:
+            keys[m['media_url']] = m['media_key']
+        for v in m.get('media_variants') or ():
+            if 'url' in v:
+                keys[v['url']] = '%s/%s' % (m['media_key'], v.get('bit_rate', v.get('content_type')))
+    return keys
+
+def make_extractors(input_type, variants='all', resolution=None):
+    """{input type: function giving the URLs of a tweet's media_objects} for a job."""
+    types = ['image', 'video'] if input_type == 'both' else [input_type]
+    extractors = {t: EXTRACTORS[t] for t in types}
+    if 'video' in extractors and variants != 'all':
+        extractors['video'] = partial(get_videos, variants=variants, resolution=resolution)
+    return extractors
+
+class SeenURLs:
+    """
+    The URLs handed out so far, kept as 64 bit hashes rather than strings so
+    a long running job can remember millions of them in little memory. Two
+    different URLs sharing a hash is unlikely enough to ignore.
+    """
+
+    def __init__(self):
+        self.hashes = set()
+
+    def add(self, url):
+        """True if url was not seen before."""
+        key = int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+        if key in self.hashes:
+            return False
+        self.hashes.add(key)
+        return True
+
+    def discard(self, url):
+        self.hashes.discard(int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little'))
+
+    def __len__(self):
+        return len(self.hashes)
+
+def iter_media_urls(file_path, extractors, with_keys=False):
+    """
+    (type, url, key) for the media of each tweet in file_path, for each input
+    type of extractors (see make_extractors), reading and decoding one line at
+    a time. key is the media key of the url (see media_keys) with with_keys,
+    otherwise None. Lines without media are
+    skipped before they are decoded. A line that is not valid JSON is logged
+    and skipped.
+    """
+    with compression.open_input(file_path) as f:
+        for index, line in enumerate(f):
+            if '"media_objects"' not in line:
+                continue
+            try:
+                media = json.loads(line).get('media_objects')
+            except ValueError as e:
+                logger.error("error on line %d of %s: %s" % (index, file_path, e))
+                continue
+            keys = media_keys(media) if with_keys else {}
+            for t, func in extractors.items():
+                for url in func(media) or ():
+                    yield t, url, keys.get(url)
+
+def parse_media_urls(input, extractors, keys=None):
+    """
+    The distinct media URLs in the tweet files of input, by input type, in one
+    pass over the files. When keys is a dict it is filled with {url: media key}.
+    """
+    seen = SeenURLs()
+    urls = {t: [] for t in extractors}
     for file in os.listdir(input):
-        if not file.endswith(".json.gz"):
+        if not compression.is_data_file(file):
             continue
         try:
             file_path = os.path.join(input, file)
             print(file_path)
-            df = pd.read_json(file_path, compression='gzip', lines=True)
-            df = df[~df['media_objects'].isnull()]
-            df['urls'] = df['media_objects'].apply(func)
-            df = df[~df['urls'].isnull()]
-            df = df[['urls']]
-            df = df.explode('urls')
-            results.append(df)
+            for t, url, key in iter_media_urls(file_path, extractors, keys is not None):
+                if seen.add(url):
+                    urls[t].append(url)
+                    if key is not None:
+                        keys[url] = key
         except Exception as e:
             print(e)
             traceback.print_exc()
             logger.error(e)
-    df = pd.concat(results, axis=0)
-    df.drop_duplicates(inplace=True)
-    return df['urls'].to_list()
+    return urls
+
+def incremental_download(input, output, extractors, manifest, seen, **options):
+    """
+    One pass of the incremental mode: parse only the files of input that the
+    manifest has not seen (or that changed), download the URLs in them that
+    were not seen before, then record the files in the manifest.
+
+    A file with a URL whose download failed for a reason that may pass (5xx,
+    429, network errors) is left out of the manifest and the URL is
+    forgotten, so the next pass, or the next run, reads the file again and
+    tries that URL once more. URLs answered with a 404 or another 4xx are not
+    tried again.
+    """
+    changed = manifest.changed(input)
+    if not changed:
+        return
+    print('%d new or changed files in %s' % (len(changed), input))
+
+    urls = {t: [] for t in extractors}
+    keys = {} if options.get('store') is not None else None
+    parsed = []
+    # the file each URL queued in this pass came from
+    sources = {}
+    for name, stat in changed:
+        file_path = os.path.join(input, name)
+        try:
+            for t, url, key in iter_media_urls(file_path, extractors, keys is not None):
+                if seen.add(url):
+                    urls[t].append(url)
+                    sources[url] = name
+                    if key is not None:
+                        keys[url] = key
+        except Exception as e:
+            # left out of the manifest so it is read again on the next pass
+            traceback.print_exc()
+            logger.error("error parsing %s: %s" % (file_path, e))
+            continue
+        parsed.append((name, stat))
+
+    failed = []
+    for t, type_urls in urls.items():
+        if type_urls:
+            failed.extend(batch_download(type_urls, output, t, media_keys=keys, **options)['failed_urls'])
+    retry = set()
+    for url in failed:
+        seen.discard(url)
+        retry.add(sources[url])
+    for name, stat in parsed:
+        if name not in retry:
+            manifest.mark(name, stat)
+    manifest.save()
+    logger.info("processed %d files, %s new urls, %d failed in %d files to read again" % (
+        len(parsed), {t: len(u) for t, u in urls.items()}, len(failed), len(retry)))
+
+def variant_report(input, variants, resolution=None, workers=8):
+    """
+    Dry run of a variant policy: ask the server for the size of every video
+    variant in the tweet files of input, without downloading anything, and
+    print how many bytes the policy would download next to all of them.
+    """
+    every = parse_media_urls(input, make_extractors('video'))['video']
+    chosen = set(parse_media_urls(input, make_extractors('video', variants, resolution))['video'])
+    sizes = MediaDownloader(workers).sizes(every)
+
+    known = [url for url in every if sizes[url] is not None]
+    total = sum(sizes[url] for url in known)
+    selected = sum(sizes[url] for url in known if url in chosen)
+    print('all variants: %d urls, %.1f MB' % (len(every), total / 1e6))
+    print('%s: %d urls, %.1f MB' % (variants, len(chosen), selected / 1e6))
+    print('saved: %.1f MB (%.0f%%)' % ((total - selected) / 1e6, 100.0 * (total - selected) / total if total else 0))
+    if len(known) < len(every):
+        print('size unknown for %d urls, left out of the totals' % (len(every) - len(known)))
+    return total, selected
+
+def loop_download(input, output, input_type, manifest_file=None, variants='all', resolution=None, **options):
+    # options are passed on to batch_download
+    extractors = make_extractors(input_type, variants, resolution)
+    if manifest_file is not None:
+        manifest = FileManifest(manifest_file)
+        seen = SeenURLs()
+        while True:
+            try:
+                incremental_download(input, output, extractors, manifest, seen, **options)
+            except Exception as e:
+                traceback.print_exc()
+                logger.error(e)
+            time.sleep(60)
 
-def loop_download(input, output, input_type):
     while True:
         try:
-            if input_type == 'image':
-                urls = parse_media_urls(input, get_images)
-                batch_download(urls, output, input_type)
-            elif input_type == 'video':
-                urls = parse_media_urls(input, get_videos)
-                batch_download(urls, output, input_type)
-            elif input_type == 'both':
-                urls1 = parse_media_urls(input, get_images)
-                batch_download(urls1, output, 'image')
-                urls2 = parse_media_urls(input, get_videos)
-                batch_download(urls2, output, 'video')
+            keys = {} if options.get('store') is not None else None
+            urls = parse_media_urls(input, extractors, keys)
+            for t, type_urls in urls.items():
+                batch_download(type_urls, output, t, media_keys=keys, **options)
         except Exception as e:
             traceback.print_exc()
             logger.error(e)
@@ -97,6 +289,21 @@ def main():
     parser.add_argument("input", metavar="INPUT", help="input directory containing all the downloaded tweet data using search2.py")
     parser.add_argument("type", help="url type: 1) image or 2) video or 3) both")
     parser.add_argument("output", help="output directory to store the output files")
+    parser.add_argument("--workers", type=int, default=8, help="number of files to download at the same time")
+    parser.add_argument("--host_delay", type=float, default=0.25, help="seconds between starting two downloads from the same host")
+    parser.add_argument("--bandwidth", type=float, help="most MB per second to download, over all hosts together")
+    parser.add_argument("--variants", choices=VARIANT_POLICIES, default="all",
+                        help="which renditions of a video to download: all, the mp4 with the highest or lowest bit rate,\n"
+                             "the mp4 closest to --resolution, or every mp4 but not the .m3u8 playlist")
+    parser.add_argument("--resolution", default="1280x720", help="target WIDTHxHEIGHT for --variants closest")
+    parser.add_argument("--dry_run", action="store_true", help="print the bytes --variants would save, from HEAD requests, and exit")
+    parser.add_argument("--store", help="keep each distinct file once in this directory and hard link it into OUTPUT;\n"
+                                          "URLs and media keys it already has are not downloaded again")
+    parser.add_argument("--incremental", action="store_true", help="only read the tweet files that are new since the last pass, remembered in --manifest")
+    parser.add_argument("--manifest", help="file listing the tweet files already read, for --incremental (default: OUTPUT/.download_media2_manifest.json)")
+    parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--metrics_file", help="append a JSON metrics snapshot to this file every --metrics_interval seconds")
+    parser.add_argument("--metrics_interval", type=float, default=60.0, help="seconds between metrics snapshots")
 
     args = parser.parse_args()
 
@@ -107,7 +314,19 @@ def main():
         os.makedirs(output)
 
     print('args: input=%s, input_type=%s, output=%s' % (input, input_type, output))
-    loop_download(input, output, input_type)
+    resolution = parse_resolution(args.resolution)
+    if args.dry_run:
+        variant_report(input, args.variants, resolution, args.workers)
+        return
+    metrics.start(args.metrics_port, args.metrics_file, args.metrics_interval)
+    options = {"sleep_time": args.host_delay, "workers": args.workers,
+               "bandwidth": args.bandwidth * 1024 * 1024 if args.bandwidth else None}
+    options.update(variants=args.variants, resolution=resolution)
+    if args.store:
+        options["store"] = MediaStore(args.store)
+    if args.incremental:
+        options["manifest_file"] = args.manifest or os.path.join(output, ".download_media2_manifest.json")
+    loop_download(input, output, input_type, **options)
     return
 
 if __name__ == '__main__':
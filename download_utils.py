@@ -1,7 +1,14 @@
 import os
+import sys
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
 import requests
+
+import metrics
 import socket
 import time
 
@@ -39,58 +46,289 @@ def get_rotating_headers():
     }
     return header
 
-def download_image(url, file_path):
+def say(message):
+    # print writes the text and the newline separately, so lines from the download threads
+    # could run together; a single write keeps each line whole
+    sys.stdout.write(message + "\n")
+
+class IncompleteDownload(Exception):
+    pass
+
+def expected_size(resp, offset):
+    # the size of the whole file: Content-Range says so on a 206 (or 416), Content-Length counts from offset
+    content_range = resp.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    length = resp.headers.get("Content-Length")
+    return offset + int(length) if length is not None else None
+
+def fetch_resumable(session, url, file_path, chunk_size=1024 * 1024, bandwidth=None, timeout=60):
+    """
+    Download url into file_path + ".part" and rename it to file_path once it
+    has as many bytes as the server said the file has. If a ".part" file is
+    already there, only the rest is asked for with a Range request, so an
+    interrupted download carries on where it stopped. Returns the number of
+    bytes received by this call.
+    """
+    part_path = file_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
     headers = get_rotating_headers()
-    resp = requests.get(url, allow_redirects=True, headers=headers)
-    with open(file_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=1024 * 1024):
-            if chunk:
-                f.write(chunk)
-    return
+    # ranges count the bytes of the file as stored, so do not let it be compressed on the way
+    headers["Accept-Encoding"] = "identity"
+    if offset:
+        headers["Range"] = "bytes={}-".format(offset)
+
+    size = 0
+    with session.get(url, allow_redirects=True, stream=True, headers=headers, timeout=timeout) as resp:
+        if resp.status_code == 416 and offset:
+            # nothing after offset; the last attempt got everything but stopped before the rename
+            if expected_size(resp, 0) == offset:
+                os.replace(part_path, file_path)
+                return 0
+            os.remove(part_path)
+            raise IncompleteDownload("{} has {} bytes, more than {} has".format(part_path, offset, url))
+        resp.raise_for_status()
+        if resp.status_code != 206 or not resp.headers.get("Content-Range", "").startswith("bytes {}-".format(offset)):
+            offset = 0  # the server sent the whole file
+        total = expected_size(resp, offset)
+
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    f.write(chunk)
+                    size += len(chunk)
+                    if bandwidth is not None:
+                        bandwidth.consume(len(chunk))
+
+    if total is not None and offset + size != total:
+        raise IncompleteDownload("got {} of {} bytes of {}".format(offset + size, total, url))
+    os.replace(part_path, file_path)
+    return size
+
+def download_image(url, file_path):
+    return fetch_resumable(requests, url, file_path)
 
 def download_video(url, file_path):
-    headers = get_rotating_headers()
-    resp = requests.get(url, allow_redirects=True, stream=True, headers=headers)
-    with open(file_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=1024 * 1024):
-            if chunk:
-                f.write(chunk)
-    return
+    return fetch_resumable(requests, url, file_path)
+
+# how many downloads may run at once on a host; other hosts get DEFAULT_HOST_LIMIT
+DEFAULT_HOST_LIMITS = {"pbs.twimg.com": 8, "video.twimg.com": 4}
+DEFAULT_HOST_LIMIT = 2
+
+
+class HostLimiter:
+    """
+    Caps the number of downloads running at once per host and spaces out
+    the start of each download from the same host by delay seconds, so a
+    slow or strict host only holds up its own downloads.
+    """
+
+    def __init__(self, limits=None, default_limit=DEFAULT_HOST_LIMIT, delay=0.0):
+        self.limits = dict(DEFAULT_HOST_LIMITS, **(limits or {}))
+        self.default_limit = default_limit
+        self.delay = delay
+        self.semaphores = {}
+        self.next_start = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).hostname or ""
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limits.get(host, self.default_limit))
+            semaphore = self.semaphores[host]
+
+        semaphore.acquire()
+        try:
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, self.next_start.get(host, now))
+                self.next_start[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+        finally:
+            semaphore.release()
+
+
+class BandwidthLimiter:
+    """Keeps all downloads together under rate bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.next_free = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        # every chunk books size / rate seconds of the line; wait until its turn comes
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
 
-def batch_download(urls, output, input_type, sleep_time=5):
-    print('total number of urls', len(urls))
-    max_retry = 3
-    for url in urls:
-        if not url.startswith("http"):
-            continue
-        file_name = url.split("/")[-1]
-        file_extension = ".jpg" if input_type=='image' else '.mp4'
-        if "." not in url[-5:]:
-            file_name = file_name + file_extension
-        file_name = os.path.join(output, file_name)
-        if os.path.exists(file_name):
-            continue
+
+def media_file_name(url, output, input_type):
+    file_name = url.split("/")[-1]
+    file_extension = ".jpg" if input_type=='image' else '.mp4'
+    if "." not in url[-5:]:
+        file_name = file_name + file_extension
+    return os.path.join(output, file_name)
+
+
+def is_permanent(error):
+    # the media is gone or was never there; asking again will not help
+    response = getattr(error, "response", None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+
+class MediaDownloader:
+    """
+    Downloads media URLs on a pool of threads (workers), each with its own
+    keep-alive session. HostLimiter decides how many downloads run per host
+    and how far apart they start, and an optional BandwidthLimiter caps the
+    bytes per second of all of them together.
+
+    Files that already exist are skipped. Files are written through a
+    ".part" file (see fetch_resumable), and a failed download is tried again
+    max_retry times from where it stopped, waiting retry_wait seconds longer
+    each time, except for 4xx responses other than 429.
+
+    With a MediaStore (store), a URL or media key the store already has is
+    linked from it instead of downloaded, and each downloaded file is added
+    to it, so identical content is kept on disk once.
+    """
+
+    def __init__(self, workers=8, host_limits=None, host_delay=0.0, bandwidth=None, max_retry=3, retry_wait=60,
+                 chunk_size=256 * 1024, store=None):
+        self.workers = workers
+        self.hosts = HostLimiter(host_limits, delay=host_delay)
+        self.bandwidth = BandwidthLimiter(bandwidth) if bandwidth else None
+        self.max_retry = max_retry
+        self.retry_wait = retry_wait
+        self.chunk_size = chunk_size
+        self.store = store
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0, "linked": 0, "duplicates": 0}
+        # failed for a reason that may pass (5xx, 429, network errors), worth trying again later
+        self.failed_urls = []
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def fetch(self, url, file_path):
+        return fetch_resumable(self.session(), url, file_path, self.chunk_size, self.bandwidth)
+
+    def download(self, url, file_path, media_key=None):
+        if self.store is not None and self.store.link_known(url, file_path, media_key):
+            self.count("linked")
+            return True
         retry = 0
         while True:
             try:
-                print('downloading', url, file_name)
-                if input_type == 'image':
-                    download_image(url, file_name)
-                else:
-                    download_video(url, file_name)
-                time.sleep(sleep_time)
-                break
+                say('downloading {} {}'.format(url, file_path))
+                with self.hosts.slot(url):
+                    size = self.fetch(url, file_path)
+                if self.store is not None and self.store.add(url, file_path, media_key):
+                    self.count("duplicates")
+                metrics.DOWNLOADS.inc()
+                metrics.DOWNLOAD_BYTES.inc(size)
+                self.count("downloaded")
+                self.count("bytes", size)
+                return True
             except Exception as e:
-                print('error downloading', e, url, file_name)
-                traceback.print_exc()
+                # the .part file is kept so the next attempt resumes it, unless there is nothing to resume
+                if is_permanent(e) and os.path.exists(file_path + ".part"):
+                    os.remove(file_path + ".part")
+                say('error downloading {} {} {}'.format(e, url, file_path))
                 logger.error(e)
-                logger.error(traceback.extract_tb())
-                time.sleep(60 * (retry+1))
-                if retry>=max_retry:
-                    break
+                logger.error(traceback.format_exc())
+                if is_permanent(e) or retry>=self.max_retry:
+                    metrics.DOWNLOAD_FAILURES.inc()
+                    self.count("failed")
+                    if not is_permanent(e):
+                        with self.lock:
+                            self.failed_urls.append(url)
+                    return False
+                time.sleep(self.retry_wait * (retry+1))
                 retry+=1
+                metrics.RETRIES.inc()
+
+    def size(self, url):
+        """The Content-Length of url from a HEAD request, or None if the server does not say."""
+        headers = get_rotating_headers()
+        headers["Accept-Encoding"] = "identity"
+        try:
+            with self.hosts.slot(url):
+                resp = self.session().head(url, allow_redirects=True, headers=headers, timeout=30)
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            return int(length) if length is not None else None
+        except Exception as e:
+            say('error getting the size of {} {}'.format(url, e))
+            logger.error(e)
+            return None
+
+    def sizes(self, urls):
+        """{url: size or None} for urls, without downloading them."""
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return dict(zip(urls, pool.map(self.size, urls)))
+
+    def run(self, urls, output, input_type, media_keys=None):
+        """
+        Download urls into output; media_keys ({url: media key}) lets a store
+        match the same media under other URLs. Returns the counts, with the
+        URLs that failed for a reason that may pass in "failed_urls".
+        """
+        print('total number of urls', len(urls))
+        media_keys = media_keys or {}
+        jobs = {}
+        # URLs of a media key that is already being downloaded, linked once the download is done
+        followers = []
+        started_keys = set()
+        for url in urls:
+            if not url.startswith("http"):
                 continue
-    return
+            file_path = media_file_name(url, output, input_type)
+            if file_path in jobs or os.path.exists(file_path):
+                self.count("skipped")
+                continue
+            key = media_keys.get(url)
+            if self.store is not None and key is not None:
+                if key in started_keys:
+                    followers.append((url, file_path, key))
+                    continue
+                started_keys.add(key)
+            jobs[file_path] = url
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for _ in pool.map(lambda job: self.download(job[1], job[0], media_keys.get(job[1])), jobs.items()):
+                pass
+            for _ in pool.map(lambda job: self.download(*job), followers):
+                pass
+        elapsed = time.monotonic() - started
+        print('downloaded {downloaded} files ({bytes} bytes), skipped {skipped}, failed {failed}, '
+              'linked {linked}, duplicates {duplicates}'.format(**self.counts), 'in {:.1f}s'.format(elapsed))
+        logger.info("download counts: {}, {:.1f}s".format(self.counts, elapsed))
+        return dict(self.counts, failed_urls=list(self.failed_urls))
+
+
+def batch_download(urls, output, input_type, sleep_time=5, workers=1, host_limits=None, bandwidth=None, store=None,
+                   media_keys=None):
+    # sleep_time is now the gap between two downloads from the same host rather than after every download
+    downloader = MediaDownloader(workers, host_limits, host_delay=sleep_time, bandwidth=bandwidth, store=store)
+    return downloader.run(urls, output, input_type, media_keys)
 
 def sample_download_image():
     url = "https://pbs.twimg.com/media/FhhP3umXEAIlzbN.jpg"
@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import time
+import traceback
+from datetime import datetime, timezone
+from glob import glob
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+import compression
+
+STRING = pa.string()
+# columns with few distinct values are stored as indexes into a dictionary of those values
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+
+# the columns of load_user_tweets.sql, typed, plus the partition column
+SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("conversation_id", pa.int64()),
+    ("created_at", TIMESTAMP),
+    ("tweet", STRING),
+    ("hashtags", pa.list_(STRING)),
+    ("urls", pa.list_(STRING)),
+    ("source", DICTIONARY),
+    ("language", DICTIONARY),
+    ("retweet_count", pa.int64()),
+    ("reply_count", pa.int64()),
+    ("like_count", pa.int64()),
+    ("quote_count", pa.int64()),
+    ("in_reply_to_user_id", pa.int64()),
+    ("user_id", pa.int64()),
+    ("user_screen_name", DICTIONARY),
+    ("user_name", STRING),
+    ("user_description", STRING),
+    ("user_location", STRING),
+    ("user_created_at", TIMESTAMP),
+    ("user_followers_count", pa.int64()),
+    ("user_friends_count", pa.int64()),
+    ("user_statuses_count", pa.int64()),
+    ("user_verified", pa.bool_()),
+    ("linked", STRING),
+    ("source_file", DICTIONARY),
+    ("date", STRING),
+])
+
+INT_COLUMNS = {"id", "conversation_id", "in_reply_to_user_id", "user_id"}
+TIME_COLUMNS = {"created_at", "user_created_at"}
+
+
+def to_int(value):
+    return int(value) if value is not None else None
+
+
+def to_time(value):
+    # "2022-10-01T12:00:00.000Z" from raw responses or "2022-10-01 12:00:00+00:00" from tweepy models
+    if value is None:
+        return None
+    value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def to_row(data: dict, tweet_file: str) -> dict:
+    row = {}
+    for name in SCHEMA.names:
+        value = data.get(name)
+        if name in INT_COLUMNS:
+            value = to_int(value)
+        elif name in TIME_COLUMNS:
+            value = to_time(value)
+        row[name] = value
+    references = data.get("references")
+    row["linked"] = json.dumps(references) if references is not None else None
+    row["source_file"] = tweet_file
+    row["date"] = row["created_at"].strftime("%Y-%m-%d")
+    return row
+
+
+def record_batches(tweet_files, batch_size: int = 50000):
+    """The tweets of tweet_files as record batches of batch_size rows, read one file at a time."""
+    columns = {name: [] for name in SCHEMA.names}
+    count = 0
+    for tweet_file in tweet_files:
+        print("reading {}".format(tweet_file))
+        with compression.open_input(tweet_file) as f:
+            for index, line in enumerate(f):
+                try:
+                    data = json.loads(line)
+                    if "id" not in data:
+                        continue
+                    row = to_row(data, tweet_file)
+                except Exception:
+                    print("error on line {} of {}".format(index, tweet_file))
+                    traceback.print_exc()
+                    continue
+
+                for name, values in columns.items():
+                    values.append(row[name])
+                count += 1
+                if count >= batch_size:
+                    yield to_batch(columns)
+                    columns = {name: [] for name in SCHEMA.names}
+                    count = 0
+    if count:
+        yield to_batch(columns)
+
+
+def to_batch(columns: dict):
+    return pa.RecordBatch.from_arrays([pa.array(columns[field.name], type=field.type) for field in SCHEMA],
+                                      schema=SCHEMA)
+
+
+def export(tweet_files, output: str, batch_size: int = 50000, rows_per_file: int = 1000000,
+           compression_name: str = "zstd"):
+    """
+    Write the tweets of tweet_files to a Parquet dataset in output, partitioned
+    by the day they were created (output/date=2022-10-01/part-...parquet).
+    Rows are converted batch_size at a time and written as they come, so
+    memory use does not depend on the size of the input.
+    """
+    started = time.time()
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        record_batches(tweet_files, batch_size),
+        output,
+        schema=SCHEMA,
+        format=file_format,
+        file_options=file_format.make_write_options(compression=compression_name),
+        partitioning=ds.partitioning(pa.schema([("date", STRING)]), flavor="hive"),
+        # several exports can add to the same dataset without overwriting each other
+        basename_template="part-{}-{{i}}.parquet".format(datetime.now().strftime("%Y%m%d_%H%M%S_%f")),
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_file=rows_per_file,
+        max_rows_per_group=min(batch_size, rows_per_file),
+    )
+    print("exported {} files to {} in {:.1f}s".format(len(tweet_files), output, time.time() - started))
+
+
+def main(**kwargs):
+    if os.path.isfile(kwargs["input"]):
+        tweet_files = [kwargs["input"]]
+    else:
+        pattern = kwargs["input"]
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        tweet_files = sorted(x for x in glob(pattern) if compression.is_data_file(x))
+
+    export(tweet_files, kwargs["output"], kwargs["batch_size"], kwargs["rows_per_file"], kwargs["compression"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="export_parquet",
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__,
+    )
+    parser.add_argument("input", help="a file, directory or glob of tweet files from search2.py, stream.py or fetch_user_tweets2.py")
+    parser.add_argument("output", help="the directory of the Parquet dataset")
+    parser.add_argument("--batch_size", type=int, default=50000, help="rows converted and written at a time")
+    parser.add_argument("--rows_per_file", type=int, default=1000000, help="most rows in one Parquet file")
+    parser.add_argument("--compression", default="zstd", help="Parquet compression: zstd, snappy, gzip or none")
+    args = parser.parse_args()
+
+    try:
+        main(**vars(args))
+    except Exception:
+        traceback.print_exc()
@@ -4,7 +4,10 @@ import json
 import argparse
 from datetime import datetime
 import os
-import gzip
+
+import compression
+import serializer
+from tweet_normalizer import REPLY_FIELDS, TweetNormalizer
 
 import logging
 logging.captureWarnings(True)
@@ -33,69 +36,7 @@ def get_tweet_ids(file_name):
             tweet_ids.append(line.strip())
     return tweet_ids
 
-def get_hashtags(entities):
-    if not entities:
-        return
-
-    hashtags = entities.get('hashtags')
-    if not hashtags:
-        return
-
-    hlst = []
-    for h in hashtags:
-        hlst.append(h['tag'])
-
-    return hlst
-
-def get_expanded_urls(entities):
-    if not entities:
-        return
-
-    urls = entities.get('urls')
-    if not urls:
-        return
-
-    ulst = []
-    for h in urls:
-        ulst.append(h['expanded_url'])
-
-    return ulst
-
-def parse_tweet(tweet, author):
-    obj = {
-        "id": tweet["id"],
-        "conversation_id": tweet["conversation_id"],
-        "created_at": tweet["created_at"],
-        "tweet": tweet["text"],
-        # "hashtags": [x["tag"] for x in tweet.get("entities", {}).get("hashtags", [])],
-        # "urls": [x["expanded_url"] for x in tweet.get("entities", {}).get("urls", [])],
-        "hashtags": get_hashtags(tweet.get('entities')),
-        "urls": get_expanded_urls(tweet.get('entities')),
-        "source": tweet.get("source", None),
-        "language": tweet["lang"],
-        "retweet_count": tweet["public_metrics"]["retweet_count"],
-        "reply_count": tweet["public_metrics"]["reply_count"],
-        "like_count": tweet["public_metrics"]["like_count"],
-        "quote_count": tweet["public_metrics"]["quote_count"],
-        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-        "possibly_sensitive": tweet["possibly_sensitive"],
-        "reply_settings": tweet["reply_settings"],
-
-        "user_id": tweet["author_id"],
-        "user_screen_name": author["username"],
-        "user_name": author["name"],
-        "user_description": author["description"],
-        "user_location": author.get("location"),
-        "user_created_at": author["created_at"],
-        "user_followers_count": author["public_metrics"]["followers_count"],
-        "user_friends_count": author["public_metrics"]["following_count"],
-        "user_statuses_count": author["public_metrics"]["tweet_count"],
-        "user_verified": author["verified"],
-
-        "references": tweet.get("referenced_tweets"),
-        "context_annotations": tweet.get("context_annotations", None),
-    }
-    return obj
+normalizer = TweetNormalizer(REPLY_FIELDS, references=False, media=False)
 
 import traceback
 def get_tweets(api, query, tweet_fields_, user_fields_, expand_fields_, start_time_, end_time_, num_pages, fetch_context_annotation):
@@ -122,18 +63,7 @@ def get_tweets(api, query, tweet_fields_, user_fields_, expand_fields_, start_ti
             if resp.data is None:
                 continue
             # print('resp.data', resp.data)
-            users = {}  # keyed by user id
-            for user in resp.includes['users']:
-                user_id = user["id"]
-                users[user_id] = user
-
-            #loop through regular tweets
-            tweets = resp.data
-            for tweet in tweets:
-                author = users.get(tweet["author_id"]) #get user object
-                obj = parse_tweet(tweet, author)
-                # print('obj', obj)
-                results.append(obj)
+            results.extend(normalizer.normalize_page(resp))
             time.sleep(1)#rate limit
         time.sleep(1)#rate limit
         return results
@@ -145,7 +75,8 @@ def get_tweets(api, query, tweet_fields_, user_fields_, expand_fields_, start_ti
         time.sleep(10)
         return
 
-def fetch_replies(api, tweet_id, write_file, start_time, end_time, num_pages,fetch_context_annotation):
+def fetch_replies(api, tweet_id, write_file, start_time, end_time, num_pages,fetch_context_annotation, codec=None):
+    codec = codec or compression.get_codec()
     user_fields = "created_at,description,entities,id,location,name,protected,public_metrics,url,username,verified,withheld"
     tweet_fields =  "attachments,author_id,conversation_id,created_at,entities,geo,id,in_reply_to_user_id,lang,public_metrics,possibly_sensitive,referenced_tweets,source,text,withheld,reply_settings"
     if fetch_context_annotation:
@@ -157,12 +88,12 @@ def fetch_replies(api, tweet_id, write_file, start_time, end_time, num_pages,fet
     if tweets:
         print("writing tweets to file, number of tweets=%s"%len(tweets))
         logger.info("writing tweets to file, number of tweets=%s"%len(tweets))
-        with gzip.open(write_file, "wt") as f:
+        with codec.open(write_file, "wb") as f:
             for tweet in tweets:
-                f.write(json.dumps(tweet, default=str) + "\n")
+                f.write(serializer.dumps_line(tweet))
     else:
-        with gzip.open(write_file, "wt") as f:
-            f.write("{}")
+        with codec.open(write_file, "wb") as f:
+            f.write(b"{}")
     return
 
 def api_test():
@@ -172,19 +103,20 @@ def api_test():
     fetch_replies(api, tweet_id, './dat/output.txt')
     return
 
-def batch_fetch_replies(credentials, input, output, start_time, end_time, num_pages,fetch_context_annotation):
+def batch_fetch_replies(credentials, input, output, start_time, end_time, num_pages,fetch_context_annotation, codec=None):
+    codec = codec or compression.get_codec()
     credentials = get_credentials(credentials)
     api = get_API(credentials)
 
     tweet_ids = get_tweet_ids(input)
     logger.info("fetching %s coverstations"%(len(tweet_ids)))
     for tweet_id in tweet_ids:
-        write_file = os.path.join(output, "replies_%s.json.gz"%(tweet_id))
+        write_file = os.path.join(output, "replies_%s.json%s"%(tweet_id, codec.extension))
         if os.path.exists(write_file): #TODO file already exists
             continue
         print('fetching replies for tweet_id=%s and write to=%s'%(tweet_id, write_file))
         logger.info('fetching replies for tweet_id=%s and write to=%s'%(tweet_id, write_file))
-        fetch_replies(api, tweet_id, write_file, start_time, end_time, num_pages,fetch_context_annotation)
+        fetch_replies(api, tweet_id, write_file, start_time, end_time, num_pages,fetch_context_annotation, codec)
     return
 
 def main():
@@ -201,6 +133,8 @@ def main():
     parser.add_argument("end_time", help="for example, '2022-10-10T00:00:00Z'")
     parser.add_argument("--fetch_context_annotation", action="store_true", default=False)
     parser.add_argument("--num_pages",default=1000)
+    parser.add_argument("--compression", default="gzip", help="gzip, zstd, lz4 or none")
+    parser.add_argument("--compression_level", type=int, default=None)
                         
     args = parser.parse_args()
 
@@ -212,7 +146,8 @@ def main():
 
     print('args: credentials=%s, input=%s, output=%s start_time=%s end_time=%s, fetch_annotation=%s'%(credentials, input, output, args.start_time, args.end_time, args.fetch_context_annotation))
 
-    batch_fetch_replies(credentials, input, output, args.start_time, args.end_time,args.num_pages, args.fetch_context_annotation)
+    codec = compression.get_codec(args.compression, args.compression_level)
+    batch_fetch_replies(credentials, input, output, args.start_time, args.end_time,args.num_pages, args.fetch_context_annotation, codec)
     return
 
 if __name__ == '__main__':
@@ -2,14 +2,25 @@ import argparse
 import json
 import logging
 import os
-import requests
 import sys
 import time
 import traceback
 from glob import glob
 
+from api_utils import add_pool_size_argument, api_get, configure_session
+from rate_limit import RateLimitGovernor
+import serializer
+from tweet_normalizer import LEGACY_FIELDS, compile_fields
+
 logger = logging.getLogger(__name__)
 
+# the full archive search allows at most one request per second
+governor = RateLimitGovernor(min_interval=1.0)
+
+
+# builds the flat record written for every tweet
+extract_tweet = compile_fields(LEGACY_FIELDS, "extract_tweet")
+
 
 def fetch(bearer_token, account_id, starting, stopping, next_token=None):
     query = "from:{}".format(account_id)
@@ -41,8 +52,9 @@ def fetch(bearer_token, account_id, starting, stopping, next_token=None):
         if next_token is not None:
             params["next_token"] = next_token
 
-        headers = {"Authorization": "Bearer {}".format(bearer_token)}
-        r = requests.get("https://api.twitter.com/2/tweets/search/all", params=params, headers=headers)
+        governor.acquire()
+        r = api_get(bearer_token, "/2/tweets/search/all", params)
+        governor.update(r.headers, r.status_code)
 
         if r.status_code >= 500:
             logger.error("received internal server error ({}) from Twitter API".format(r.status_code))
@@ -63,11 +75,9 @@ def fetch(bearer_token, account_id, starting, stopping, next_token=None):
             return
 
         if r.status_code == 429:
-            logger.error("reached rate limit, sleeping for {} seconds".format(seconds_remaining))
-            time.sleep(seconds_remaining + 1)
+            # the governor holds the next request until the window resets
+            logger.error("reached rate limit, waiting {} seconds for the window to reset".format(seconds_remaining))
             return
-        else:
-            time.sleep(1)
 
         return r.json()
     except json.decoder.JSONDecodeError as e:
@@ -86,39 +96,12 @@ def parse(raw, file_path):
         tweet_id = tweet["id"]
         linked_tweets[tweet_id] = tweet
 
-    with open(file_path, "at") as f:
+    with open(file_path, "ab") as f:
         for tweet in raw.get("data", []) + list(linked_tweets.values()):
             author = users.get(tweet["author_id"])
 
-            obj = {
-                "id": tweet["id"],
-                "conversation_id": tweet["conversation_id"],
-                "created_at": tweet["created_at"],
-                "tweet": tweet["text"],
-                "hashtags": [x["tag"] for x in tweet.get("entities", {}).get("hashtags", [])],
-                "urls": [x["expanded_url"] for x in tweet.get("entities", {}).get("urls", [])],
-                "source": tweet.get("source", None),
-                "language": tweet["lang"],
-                "retweet_count": tweet["public_metrics"]["retweet_count"],
-                "reply_count": tweet["public_metrics"]["reply_count"],
-                "like_count": tweet["public_metrics"]["like_count"],
-                "quote_count": tweet["public_metrics"]["quote_count"],
-                "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-
-                "user_id": tweet["author_id"],
-                "user_screen_name": author["username"],
-                "user_name": author["name"],
-                "user_description": author["description"],
-                "user_location": author.get("location"),
-                "user_created_at": author["created_at"],
-                "user_followers_count": author["public_metrics"]["followers_count"],
-                "user_friends_count": author["public_metrics"]["following_count"],
-                "user_statuses_count": author["public_metrics"]["tweet_count"],
-                "user_verified": author["verified"],
-
-                "references": tweet.get("referenced_tweets"),
-            }
-            print(json.dumps(obj), file=f)
+            obj = extract_tweet(tweet, author)
+            f.write(serializer.dumps_line(obj))
 
     return len(raw.get("data", []))
 
@@ -132,6 +115,8 @@ def main(**kwargs):
         if bearer_token is None:
             raise RuntimeError("could not load bearer token from credentials.json")
 
+    configure_session(pool_maxsize=kwargs.get("pool_size"))
+
     # see what we have loaded already
     loaded = [os.path.split(x)[1].split(".", -1)[0] for x in glob(os.path.join(kwargs["output"], "*")) if (x.endswith(".json"))]
 
@@ -183,6 +168,7 @@ if __name__ == "__main__":
     parser.add_argument("--stopping", required=True, help="the time to stop the search (YYYY-MM-DDTHH:mm:ssZ)")
     parser.add_argument("--credentials", required=True, help="the json file containing bearer token")
     # parser.add_argument("--include_refs", required=True, help="whether or not to return items referenced in the tweet") 
+    add_pool_size_argument(parser)
     args = parser.parse_args()
 
     # configure a basic logger
@@ -2,22 +2,34 @@ import argparse
 import json
 import logging
 import os
-import requests
 import sys
 import time
 import traceback
-from glob import glob
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from api_utils import DEFAULT_POOL_MAXSIZE, add_pool_size_argument, api_get, configure_session
+from rate_limit import RateLimitGovernor
+from resume_ledger import COMPLETED, FAILED, ResumeLedger
+import serializer
+from tweet_normalizer import LEGACY_FIELDS, compile_fields
 
 logger = logging.getLogger(__name__)
 # configure a basic logger
 logging.basicConfig(format="%(asctime)s %(levelname)-8s - %(message)s", level=logging.INFO)
 
+governor = RateLimitGovernor()
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
 
+# builds the flat record written for every tweet
+extract_tweet = compile_fields(LEGACY_FIELDS, "extract_tweet")
+
+
 def fetch(bearer_token, tweet_ids):
     try:
         params = {
@@ -33,8 +45,9 @@ def fetch(bearer_token, tweet_ids):
             "place.fields": "contained_within,country,country_code,full_name,geo,id,name,place_type",
         }
 
-        headers = {"Authorization": "Bearer {}".format(bearer_token)}
-        r = requests.get("https://api.twitter.com/2/tweets", params=params, headers=headers)
+        governor.acquire()
+        r = api_get(bearer_token, "/2/tweets", params)
+        governor.update(r.headers, r.status_code)
 
         if r.status_code >= 500:
             logger.error("received internal server error ({}) from Twitter API".format(r.status_code))
@@ -55,8 +68,8 @@ def fetch(bearer_token, tweet_ids):
             return
 
         if r.status_code == 429:
-            logger.error("reached rate limit, sleeping for {} seconds".format(seconds_remaining))
-            time.sleep(seconds_remaining + 1)
+            # the governor holds the next request until the window resets
+            logger.error("reached rate limit, waiting {} seconds for the window to reset".format(seconds_remaining))
             return
 
         return r.json()
@@ -76,7 +89,7 @@ def unwrap_references(tweet, linked_tweets):
     return tweets
 
 
-def parse(tweet_ids, raw, file_path):
+def parse(tweet_ids, raw, file_path, ledger=None):
     if "errors" in raw and isinstance(raw["errors"], list):
         for error in raw["errors"]:
             if error["resource_type"] == "tweet":
@@ -85,8 +98,10 @@ def parse(tweet_ids, raw, file_path):
                 if tweet_id not in tweet_ids:
                     continue
 
-                with open(os.path.join(file_path, "{}.json".format(tweet_id)), "wt") as f:
-                    print(json.dumps(error), file=f)
+                with open(os.path.join(file_path, "{}.json".format(tweet_id)), "wb") as f:
+                    f.write(serializer.dumps_line(error))
+                if ledger is not None:
+                    ledger.add(tweet_id, FAILED)
 
     users = {}  # keyed by user id
     for user in raw.get("includes", {}).get("users", []):
@@ -107,43 +122,66 @@ def parse(tweet_ids, raw, file_path):
         groups[tweet_id] = [tweet] + unwrap_references(tweet, linked_tweets)
 
     for group_id, tweets in groups.items():
-        with open(os.path.join(file_path, "{}.json".format(group_id)), "wt") as f:
+        with open(os.path.join(file_path, "{}.json".format(group_id)), "wb") as f:
             for tweet in tweets:
                 tweet_id = tweet["id"]
                 author = users.get(tweet["author_id"])
 
-                obj = {
-                    "id": tweet["id"],
-                    "conversation_id": tweet["conversation_id"],
-                    "created_at": tweet["created_at"],
-                    "tweet": tweet["text"],
-                    "hashtags": [x["tag"] for x in tweet.get("entities", {}).get("hashtags", [])],
-                    "urls": [x["expanded_url"] for x in tweet.get("entities", {}).get("urls", [])],
-                    "source": tweet.get("source", None),
-                    "language": tweet["lang"],
-                    "retweet_count": tweet["public_metrics"]["retweet_count"],
-                    "reply_count": tweet["public_metrics"]["reply_count"],
-                    "like_count": tweet["public_metrics"]["like_count"],
-                    "quote_count": tweet["public_metrics"]["quote_count"],
-                    "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-
-                    "user_id": tweet["author_id"],
-                    "user_screen_name": author["username"],
-                    "user_name": author["name"],
-                    "user_description": author["description"],
-                    "user_location": author.get("location"),
-                    "user_created_at": author["created_at"],
-                    "user_followers_count": author["public_metrics"]["followers_count"],
-                    "user_friends_count": author["public_metrics"]["following_count"],
-                    "user_statuses_count": author["public_metrics"]["tweet_count"],
-                    "user_verified": author["verified"],
-
-                    "references": tweet.get("referenced_tweets"),
-                }
-                print(json.dumps(obj), file=f)
+                obj = extract_tweet(tweet, author)
+                f.write(serializer.dumps_line(obj))
+        if ledger is not None:
+            ledger.add(group_id, COMPLETED)
+
+    if ledger is not None:
+        ledger.flush()
     return len(raw.get("data", []))
 
 
+def fetch_chunk(bearer_token, chunk):
+    while True:
+        results = fetch(bearer_token, chunk)
+        if results is not None:
+            return results  # otherwise try the page again
+
+
+def hydrate_concurrently(bearer_token, tweet_ids, file_path, concurrency, ledger=None):
+    """Keep up to `concurrency` lookups in flight and parse each one as it comes back."""
+    page = 0
+    requested = 0
+    found = 0
+
+    pending = chunks(tweet_ids, 100)
+    retries = deque()  # chunks that failed to parse go around again
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            # the rate limit governor in fetch() paces the workers, this just bounds the queue
+            while len(in_flight) < concurrency * 2:
+                chunk = retries.popleft() if retries else next(pending, None)
+                if chunk is None:
+                    break
+                in_flight[executor.submit(fetch_chunk, bearer_token, chunk)] = chunk
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = in_flight.pop(future)
+                results = future.result()
+
+                try:
+                    page = page + 1
+                    requested = requested + len(chunk)
+                    total = parse(chunk, results, file_path, ledger)
+                    found = found + total
+                    logger.info("page {} returned {} tweets, requested {} and fetched {} total tweets".format(page, total, requested, found))
+                except Exception as e:
+                    logger.error("GENERAL EXCEPTION: {}".format(e))
+                    logger.error(traceback.format_exc())
+                    retries.append(chunk)
+
+
 def main(**kwargs):
     # load credentials
     bearer_token = None
@@ -153,8 +191,13 @@ def main(**kwargs):
         if bearer_token is None:
             raise RuntimeError("could not load bearer token from credentials.json")
 
-    # see what we have loaded already
-    loaded = [os.path.split(x)[1].split(".", -1)[0] for x in glob(os.path.join(kwargs["output"], "*")) if (x.endswith(".json"))]
+    configure_session(pool_maxsize=max(kwargs.get("pool_size") or DEFAULT_POOL_MAXSIZE, kwargs.get("concurrency") or 1))
+
+    # see what we have loaded already. the ledger is seeded from the output
+    # directory until a seed has run to the end, for jobs started before it existed
+    ledger = ResumeLedger(os.path.join(kwargs["output"], ".ledger"))
+    if not ledger.seeded:
+        ledger.seed_from_directory(kwargs["output"])
 
     # get the list of ids
     if kwargs["tweet_ids"] is not None:
@@ -166,14 +209,23 @@ def main(**kwargs):
         source = sys.stdin
         
     tweet_ids = []
+    skipped = 0
     for line in source:
         tweet_id = line.strip().strip('"')
 
         # find tweet ids that we've already loaded and do not load them again
-        if tweet_id not in loaded:
+        if tweet_id not in ledger:
             tweet_ids.append(tweet_id)
         else:
-            logger.info("already loaded {}".format(tweet_id))
+            logger.debug("already loaded {}".format(tweet_id))
+            skipped = skipped + 1
+    logger.info("skipping {} tweet ids that were already loaded".format(skipped))
+
+    concurrency = kwargs.get("concurrency") or 1
+    if concurrency > 1:
+        hydrate_concurrently(bearer_token, tweet_ids, kwargs["output"], concurrency, ledger)
+        ledger.close()
+        return
 
     page = 0
     requested = 0
@@ -187,7 +239,7 @@ def main(**kwargs):
             try:
                 page = page + 1
                 requested = requested + len(chunk)
-                total = parse(chunk, results, kwargs["output"])
+                total = parse(chunk, results, kwargs["output"], ledger)
                 found = found + total
                 logger.info("page {} returned {} tweets, requested {} and fetched {} total tweets".format(page, total, requested, found))
                 break
@@ -195,6 +247,8 @@ def main(**kwargs):
                 logger.error("GENERAL EXCEPTION: {}".format(e))
                 logger.error(traceback.format_exc())
 
+    ledger.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -204,6 +258,8 @@ if __name__ == "__main__":
     )
     parser.add_argument("--output", required=True, help="path to directory where outputs will be written")
     parser.add_argument("--tweet_ids",help="file containing tweet ids to hydrate, one per line (otherwise use standard in")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of lookups to keep in flight at once (optional)")
+    add_pool_size_argument(parser)
     args = parser.parse_args()
     
     
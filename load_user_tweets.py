@@ -1,17 +1,42 @@
 import argparse
+import io
 import json
 import getpass
+import multiprocessing
+import multiprocessing.util
 import os
 import psycopg2
+from psycopg2 import sql
 import re
+import shutil
 import sys
+import tempfile
+import time
 import traceback
 from glob import glob
 
+import compression
+from premerge import PreMerger
+
 
 # compile this for performance later in the module
 NULL_TERMINATOR = re.compile(r"(?<!\\)\\u0000")
 
+# the columns of load_user_tweets.sql, in order
+COLUMNS = [
+    "id", "conversation_id", "created_at", "tweet", "hashtags", "urls", "source", "language",
+    "retweet_count", "reply_count", "like_count", "quote_count", "in_reply_to_user_id",
+    "user_id", "user_screen_name", "user_name", "user_description", "user_location", "user_created_at",
+    "user_followers_count", "user_friends_count", "user_statuses_count", "user_verified",
+    "linked", "source_files",
+]
+
+# COPY text format escapes
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+# the connection and settings of a loader process
+_worker = {}
+
 
 def replace_null_terminators(text: str, replacement: str = r""):
     return NULL_TERMINATOR.sub(replacement, text) if text is not None else None
@@ -19,63 +44,243 @@ def replace_null_terminators(text: str, replacement: str = r""):
 
 def main(**kwargs):
     if os.path.isfile(kwargs["input"]):
-        load(kwargs["host"], kwargs["database"], kwargs["username"], kwargs["table"], kwargs["input"])
+        tweet_files = [kwargs["input"]]
     else:
-        tweet_files = [x for x in glob(kwargs["input"]) if (x.endswith(".json") or x.endswith(".json.gz"))]
-        for tweet_file in tweet_files:
-            load(kwargs["host"], kwargs["database"], kwargs["username"], kwargs["table"], tweet_file)
+        tweet_files = [x for x in glob(kwargs["input"]) if compression.is_data_file(x)]
 
+    if kwargs.get("premerge"):
+        directory = tempfile.mkdtemp(prefix="load_user_tweets_", dir=kwargs.get("premerge_dir"))
+        try:
+            merger = PreMerger(directory, kwargs.get("premerge_buckets", 64))
+            print("pre-merging {} files in {}".format(len(tweet_files), directory))
+            merged_files = merger.merge(tweet_files, replace_null_terminators)
+            print("pre-merged {} records into {} tweets".format(merger.records, merger.merged))
+            _load_files(merged_files, **kwargs)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    else:
+        _load_files(tweet_files, **kwargs)
 
-def load(host: str, database: str, username: str, table: str, tweet_file: str):
-    print("loading {} into {} on {} on {}".format(tweet_file, table, database, host))
+
+def _load_files(tweet_files, **kwargs):
+    workers = kwargs.get("workers") or 1
+    settings = (kwargs["host"], kwargs["database"], kwargs["username"], kwargs["table"],
+                kwargs.get("copy", False), kwargs.get("batch_size", 50000))
+    started = time.perf_counter()
+    rows = 0
+    failed = []
+
+    def report(done, result):
+        nonlocal rows
+        tweet_file, file_rows, seconds, error = result
+        rows += file_rows
+        if error is not None:
+            failed.append(tweet_file)
+        print("[{}/{}] {} rows from {} in {:.1f}s{}".format(
+            done, len(tweet_files), file_rows, tweet_file, seconds, " (failed: {})".format(error) if error else ""))
+
+    if workers == 1:
+        _init_worker(*settings)
+        try:
+            for done, tweet_file in enumerate(tweet_files, 1):
+                report(done, _load_in_worker(tweet_file))
+        finally:
+            _worker["conn"].close()
+    else:
+        # one long-lived connection per process; files go to whichever process is free
+        with multiprocessing.Pool(workers, _init_worker, settings) as pool:
+            for done, result in enumerate(pool.imap_unordered(_load_in_worker, tweet_files), 1):
+                report(done, result)
+            # let the processes exit on their own, closing their connections; leaving the block terminates them
+            pool.close()
+            pool.join()
+
+    elapsed = time.perf_counter() - started
+    print("loaded {} rows from {} files with {} workers in {:.1f}s ({:.0f} rows/s)".format(
+        rows, len(tweet_files) - len(failed), workers, elapsed, rows / max(elapsed, 1e-9)))
+    if failed:
+        print("{} files failed: {}".format(len(failed), ", ".join(failed)))
+
+
+def _init_worker(host: str, database: str, username: str, table: str, copy: bool, batch_size: int):
     conn = psycopg2.connect(host=host, dbname=database, user=username)
+    # run when a pool process exits
+    multiprocessing.util.Finalize(None, conn.close, exitpriority=10)
+    _worker.update(conn=conn, table=table, copy=copy, batch_size=batch_size)
 
-    try:
-        with open(tweet_file, "rt") as f:
-            for index, line in enumerate(f):
-                try:
-                    line = replace_null_terminators(line)
-                    data = json.loads(line)
-                    if "id" not in data:
-                        continue
-
-                    data["source_files"] = [tweet_file]
-                    with conn.cursor() as cur:
-                        # convert the references to a json thingy
-                        references = data.pop("references", None)
-                        if references is not None:
-                            data["linked"] = json.dumps(references)
-                        else:
-                            data["linked"] = None
-
-                        cur.execute("""
-                            INSERT INTO {table} (
-                                id, conversation_id, created_at, tweet, hashtags, urls, source, language,
-                                retweet_count, reply_count, like_count, quote_count, in_reply_to_user_id,
-                                user_id, user_screen_name, user_name, user_description, user_location, user_created_at,
-                                user_followers_count, user_friends_count, user_statuses_count, user_verified,
-                                linked, source_files
-                            ) VALUES (
-                                %(id)s, %(conversation_id)s, %(created_at)s, %(tweet)s, %(hashtags)s, %(urls)s, %(source)s, %(language)s,
-                                %(retweet_count)s, %(reply_count)s, %(like_count)s, %(quote_count)s, %(in_reply_to_user_id)s,
-                                %(user_id)s, %(user_screen_name)s, %(user_name)s, %(user_description)s, %(user_location)s, %(user_created_at)s,
-                                %(user_followers_count)s, %(user_friends_count)s, %(user_statuses_count)s, %(user_verified)s,
-                                %(linked)s, %(source_files)s
-                            )
-                            ON CONFLICT (id) DO UPDATE SET
-                                source_files = (SELECT ARRAY(SELECT DISTINCT UNNEST({table}.source_files || excluded.source_files)))
-                        """.format(table=table), data)
-                except Exception as e:
-                    print("error on line {}".format(index))
-                    raise
 
-        conn.commit()
-    except Exception:
+def _load_in_worker(tweet_file: str):
+    return load_file(_worker["conn"], _worker["table"], tweet_file, _worker["copy"], _worker["batch_size"])
+
+
+def load_file(conn, table: str, tweet_file: str, copy: bool = False, batch_size: int = 50000):
+    """Load one file on an open connection and return (tweet_file, rows, seconds, error)."""
+    started = time.perf_counter()
+    error = None
+    try:
+        if copy:
+            rows = copy_load(conn, table, tweet_file, batch_size)
+        else:
+            rows = insert_load(conn, table, tweet_file)
+    except Exception as e:
         traceback.print_exc()
         try:
-            self.cnx.rollback()
+            conn.rollback()
         except Exception:
             pass
+        rows, error = 0, str(e)
+    return tweet_file, rows, time.perf_counter() - started, error
+
+
+def read_records(tweet_file: str):
+    """The tweets in a file as dicts with the extra columns of the table filled in."""
+    with compression.open_input(tweet_file) as f:
+        for index, line in enumerate(f):
+            try:
+                line = replace_null_terminators(line)
+                data = json.loads(line)
+            except Exception:
+                print("error on line {}".format(index))
+                raise
+            if "id" not in data:
+                continue
+
+            # pre-merged records already list the files they came from
+            data.setdefault("source_files", [tweet_file])
+            # convert the references to a json thingy
+            references = data.pop("references", None)
+            if references is not None:
+                data["linked"] = json.dumps(references)
+            else:
+                data["linked"] = None
+            yield data
+
+
+def copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, list):
+        # array literal; every element quoted so commas and braces need no special care
+        value = "{" + ",".join(
+            "NULL" if v is None else '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for v in value
+        ) + "}"
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_row(data: dict) -> str:
+    return "\t".join(copy_value(data.get(column)) for column in COLUMNS) + "\n"
+
+
+def copy_load(conn, table: str, tweet_file: str, batch_size: int = 50000):
+    """
+    Load a file with COPY instead of one INSERT per tweet. Every batch_size
+    rows are copied into a staging table and merged into the target with a
+    single upsert that keeps the union of source_files, like insert_load()
+    does, and committed. Returns the number of rows read.
+    """
+    print("copying {} into {} in batches of {}".format(tweet_file, table, batch_size))
+    # a temporary table cannot be put in a schema, so it is named after the table without one
+    staging = sql.Identifier(table.rsplit(".", 1)[-1] + "_staging")
+    target = sql.Identifier(*table.split("."))
+    columns = sql.SQL(", ").join(map(sql.Identifier, COLUMNS))
+    # a temporary table is not written to the WAL, like an unlogged one, and is private to this
+    # connection, so several loaders can run at once; seq keeps the order the rows were read in
+    create = sql.SQL("CREATE TEMPORARY TABLE IF NOT EXISTS {staging} (LIKE {table}, seq bigserial)").format(
+        staging=staging, table=target)
+    copy = sql.SQL("COPY {staging} ({columns}) FROM STDIN").format(staging=staging, columns=columns)
+    # the first copy of a tweet wins, as with one INSERT per tweet; the source files of all of them are kept
+    merge = sql.SQL("""
+        WITH files AS (
+            SELECT id, array_agg(DISTINCT f) AS source_files
+            FROM {staging}, UNNEST(source_files) AS f
+            GROUP BY id
+        )
+        INSERT INTO {table} AS t ({columns})
+        SELECT DISTINCT ON (s.id) {selected}, files.source_files
+        FROM {staging} s JOIN files USING (id)
+        -- every loader locks rows in id order, so concurrent batches cannot deadlock each other
+        ORDER BY s.id, s.seq
+        ON CONFLICT (id) DO UPDATE SET
+            source_files = (SELECT ARRAY(SELECT DISTINCT UNNEST(t.source_files || excluded.source_files)))
+    """).format(staging=staging, table=target, columns=columns,
+                selected=sql.SQL(", ").join(sql.Identifier("s", column) for column in COLUMNS if column != "source_files"))
+    truncate = sql.SQL("TRUNCATE {}").format(staging)
+
+    def flush(buffer):
+        buffer.seek(0)
+        with conn.cursor() as cur:
+            cur.execute(create)
+            cur.copy_expert(copy, buffer)
+            cur.execute(merge)
+            cur.execute(truncate)
+        conn.commit()
+
+    rows = 0
+    buffer = io.StringIO()
+    count = 0
+    for data in read_records(tweet_file):
+        buffer.write(copy_row(data))
+        count += 1
+        if count >= batch_size:
+            flush(buffer)
+            rows += count
+            buffer = io.StringIO()
+            count = 0
+    if count:
+        flush(buffer)
+        rows += count
+    return rows
+
+
+def load(host: str, database: str, username: str, table: str, tweet_file: str):
+    print("loading {} into {} on {} on {}".format(tweet_file, table, database, host))
+    conn = psycopg2.connect(host=host, dbname=database, user=username)
+    try:
+        return load_file(conn, table, tweet_file)
+    finally:
+        conn.close()
+
+
+def insert_load(conn, table: str, tweet_file: str):
+    """
+    Load a file with one INSERT per tweet in a single transaction and return
+    the number of rows. The tweets are inserted in id order, so every loader
+    locks rows in the same order and concurrent files cannot deadlock each
+    other; copies of a tweet within the file keep the order they were read in.
+    """
+    records = sorted(read_records(tweet_file), key=lambda data: int(data["id"]))
+    rows = 0
+    for index, data in enumerate(records):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO {table} (
+                        id, conversation_id, created_at, tweet, hashtags, urls, source, language,
+                        retweet_count, reply_count, like_count, quote_count, in_reply_to_user_id,
+                        user_id, user_screen_name, user_name, user_description, user_location, user_created_at,
+                        user_followers_count, user_friends_count, user_statuses_count, user_verified,
+                        linked, source_files
+                    ) VALUES (
+                        %(id)s, %(conversation_id)s, %(created_at)s, %(tweet)s, %(hashtags)s, %(urls)s, %(source)s, %(language)s,
+                        %(retweet_count)s, %(reply_count)s, %(like_count)s, %(quote_count)s, %(in_reply_to_user_id)s,
+                        %(user_id)s, %(user_screen_name)s, %(user_name)s, %(user_description)s, %(user_location)s, %(user_created_at)s,
+                        %(user_followers_count)s, %(user_friends_count)s, %(user_statuses_count)s, %(user_verified)s,
+                        %(linked)s, %(source_files)s
+                    )
+                    ON CONFLICT (id) DO UPDATE SET
+                        source_files = (SELECT ARRAY(SELECT DISTINCT UNNEST({table}.source_files || excluded.source_files)))
+                """.format(table=table), data)
+        except Exception as e:
+            print("error on tweet {}".format(data["id"]))
+            raise
+        rows += 1
+
+    conn.commit()
+    return rows
 
 
 if __name__ == "__main__":
@@ -91,6 +296,12 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--database", help="the database to load the data into", default=username)
     parser.add_argument("-u", "--username", help="the name of the user to use when connecting to the database", default=username)
     parser.add_argument("-t", "--table", help="the name of the database table to load this into", required=True)
+    parser.add_argument("--copy", action="store_true", help="bulk load with COPY through a staging table")
+    parser.add_argument("--batch_size", type=int, default=50000, help="rows per COPY batch with --copy")
+    parser.add_argument("--premerge", action="store_true", help="merge duplicate tweets across all files before loading")
+    parser.add_argument("--premerge_dir", help="directory for the pre-merge files (the system temp directory)")
+    parser.add_argument("--premerge_buckets", type=int, default=64, help="number of pre-merge buckets; more use less memory")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of files to load at the same time")
     args = parser.parse_args()
 
     try:
@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+
+import compression
+
+logger = logging.getLogger(__name__)
+
+
+class FileManifest:
+    """
+    Remembers which tweet files of a directory have been processed, by name,
+    size and modification time, and keeps that list in a JSON file so a
+    restarted job does not start over.
+
+    changed() lists the data files that are new or whose size or mtime
+    differ from what was recorded. The writers of this repo publish a file
+    by renaming it from a .tmp name once it is complete, and .tmp files are
+    not data files, so every file listed is sealed; a file that still
+    changes afterwards is simply listed again. mark() records a file as
+    processed and save() writes the manifest, replacing the old one in one
+    step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, "rt") as f:
+                self.files = {name: tuple(entry) for name, entry in json.load(f).items()}
+            logger.info("{} files already processed according to {}".format(len(self.files), path))
+
+    def changed(self, directory):
+        """(name, (size, mtime_ns)) of the data files of directory not processed yet, oldest first."""
+        results = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not compression.is_data_file(entry.name):
+                    continue
+                stat = entry.stat()
+                key = (stat.st_size, stat.st_mtime_ns)
+                if self.files.get(entry.name) != key:
+                    results.append((entry.name, key))
+        results.sort(key=lambda result: result[1][1])
+        return results
+
+    def mark(self, name, key):
+        self.files[name] = key
+
+    def save(self):
+        with open(self.path + ".tmp", "wt") as f:
+            json.dump({name: list(key) for name, key in self.files.items()}, f)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaStore:
+    """
+    Keeps each distinct media file once, under the SHA-256 of its content
+    (root/blobs/ab/abcdef....jpg), and hard links it to every name it was
+    downloaded as, so a photo shared by many retweets or reached through
+    several URLs takes its bytes on disk once.
+
+    root/index.jsonl records, one line per download, the url, the media key
+    it was found under and the hash of what it fetched. It is read back on
+    start, so later runs can link a file from a known URL or media key
+    instead of downloading it again. For videos the media key includes the
+    variant, since each rendition is a different file.
+
+    Hard links need the blobs and the output on the same file system; where
+    linking fails the blob is copied instead.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        self.index_path = os.path.join(root, "index.jsonl")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self.urls = {}
+        self.keys = {}
+        self.blobs = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._remember(json.loads(line))
+                    except ValueError:
+                        # a line cut short when the last run stopped
+                        continue
+            logger.info("{} blobs, {} urls and {} media keys in {}".format(
+                len(self.blobs), len(self.urls), len(self.keys), self.index_path))
+        self.index = open(self.index_path, "at", encoding="utf-8")
+
+    def _remember(self, entry):
+        self.blobs[entry["sha256"]] = entry["blob"]
+        self.urls[entry["url"]] = entry["sha256"]
+        if entry.get("media_key"):
+            self.keys[entry["media_key"]] = entry["sha256"]
+
+    def blob_path(self, sha256, extension):
+        return os.path.join(self.blob_dir, sha256[:2], sha256 + extension)
+
+    def find(self, url, media_key=None):
+        """The blob already stored for url or media_key, or None."""
+        with self.lock:
+            sha256 = self.urls.get(url) or (self.keys.get(media_key) if media_key else None)
+            blob = self.blobs.get(sha256) if sha256 else None
+        if blob is None or not os.path.exists(os.path.join(self.root, blob)):
+            return None
+        return os.path.join(self.root, blob)
+
+    def link(self, blob_path, file_path):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(blob_path, file_path)
+        except OSError as e:
+            logger.warning("cannot link {} to {}, copying it: {}".format(blob_path, file_path, e))
+            shutil.copyfile(blob_path, file_path)
+
+    def link_known(self, url, file_path, media_key=None):
+        """Link the stored copy of url (or of media_key) to file_path; False if there is none."""
+        blob_path = self.find(url, media_key)
+        if blob_path is None:
+            return False
+        self.link(blob_path, file_path)
+        with self.lock:
+            new = url not in self.urls or (media_key and media_key not in self.keys)
+        if new:
+            self._record(url, media_key, os.path.basename(blob_path).split(".")[0], blob_path)
+        return True
+
+    def add(self, url, file_path, media_key=None):
+        """
+        Store the file just downloaded to file_path: it becomes the blob if
+        its content is new, otherwise it is replaced by a link to the blob
+        with the same content. Returns True if the content was already there.
+        """
+        sha256 = file_hash(file_path)
+        extension = os.path.splitext(file_path)[1]
+        with self.lock:
+            blob = self.blobs.get(sha256)
+            blob_path = os.path.join(self.root, blob) if blob else None
+            duplicate = blob_path is not None and os.path.exists(blob_path)
+            if not duplicate:
+                blob_path = self.blob_path(sha256, extension)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                # a rename within a file system, a copy and delete when the store is on another one
+                shutil.move(file_path, blob_path)
+                self.blobs[sha256] = os.path.relpath(blob_path, self.root)
+        self.link(blob_path, file_path)
+        self._record(url, media_key, sha256, blob_path)
+        return duplicate
+
+    def _record(self, url, media_key, sha256, blob_path):
+        entry = {"url": url, "media_key": media_key, "sha256": sha256,
+                 "blob": os.path.relpath(blob_path, self.root)}
+        with self.lock:
+            self._remember(entry)
+            self.index.write(json.dumps(entry) + "\n")
+            self.index.flush()
+
+    def close(self):
+        self.index.close()
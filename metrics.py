@@ -0,0 +1,265 @@
+"""
+In-process metrics for the streamer, the batch fetchers and the download tools.
+
+Metrics live in a Registry. start() can serve them over HTTP in the Prometheus
+text format and/or append a JSON snapshot to a file every few seconds; the
+snapshots also carry per-second rates of the counters since the previous one.
+Nothing is served or written unless start() is called, so instrumented code
+costs a few counter increments when metrics are off.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# seconds; from a tenth of a millisecond (one tweet) up to a few seconds (a slow page)
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in key) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=None):
+        key = _label_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge:
+    """A value that is set, or read from callback() whenever it is reported."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, callback=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, labels=None):
+        with self._lock:
+            self.values[_label_key(labels)] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                return [(self.name, (), self.callback())]
+            except Exception as e:
+                logger.debug("metrics: gauge {} failed: {}".format(self.name, e))
+                return []
+        with self._lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        with self._lock:
+            target = q * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+                seen += count
+                if count and seen >= target:
+                    return bound
+        return None
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            samples.append((self.name + "_bucket", (("le", "+Inf" if bound == float("inf") else repr(bound)),), cumulative))
+        samples.append((self.name + "_sum", (), total))
+        samples.append((self.name + "_count", (), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._last_snapshot = None
+
+    def _add(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, callback=None):
+        gauge = self._add(Gauge(name, help))
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, key, value in metric.samples():
+                lines.append("{}{} {}".format(name, _format_labels(key), value))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, update=True):
+        """
+        Current values, histogram percentiles and the per-second counter rates
+        since the last snapshot taken with update=True, as a dict.
+        """
+        now = time.time()
+        values = {}
+        rates = {}
+        for metric in list(self.metrics.values()):
+            if isinstance(metric, Histogram):
+                values[metric.name] = {"count": metric.count, "sum": metric.sum,
+                                       "p50": metric.quantile(0.5), "p99": metric.quantile(0.99)}
+                continue
+            for name, key, value in metric.samples():
+                values[name + _format_labels(key)] = value
+
+        with self._lock:
+            if self._last_snapshot is not None:
+                then, previous = self._last_snapshot
+                elapsed = max(now - then, 1e-9)
+                for metric in list(self.metrics.values()):
+                    if isinstance(metric, Counter):
+                        for name, key, value in metric.samples():
+                            label = name + _format_labels(key)
+                            rates[label + "_per_second"] = (value - previous.get(label, 0)) / elapsed
+            if update:
+                self._last_snapshot = (now, values)
+        return {"time": now, "values": values, "rates": rates}
+
+
+registry = Registry()
+
+TWEETS = registry.counter("twitter_tweets_total", "Tweets written to the output")
+BYTES_WRITTEN = registry.counter("twitter_bytes_written_total", "Uncompressed bytes of JSON written to the output")
+PARSE_SECONDS = registry.histogram("twitter_parse_seconds", "Time to normalize one page or stream response")
+SERIALIZE_SECONDS = registry.histogram("twitter_serialize_seconds", "Time to serialize one tweet")
+WRITER_QUEUE_DEPTH = registry.gauge("twitter_writer_queue_depth", "Responses waiting for the writer thread")
+RATE_LIMIT_REMAINING = registry.gauge("twitter_rate_limit_remaining", "Requests left in the rate limit window")
+RETRIES = registry.counter("twitter_retries_total", "Requests or pages that were retried")
+RECONNECTS = registry.counter("twitter_reconnects_total", "Times the stream connected again after the first time")
+DOWNLOADS = registry.counter("twitter_downloads_total", "Media files downloaded")
+DOWNLOAD_BYTES = registry.counter("twitter_download_bytes_total", "Bytes of media downloaded")
+DOWNLOAD_FAILURES = registry.counter("twitter_download_failures_total", "Media downloads that failed")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics.json":
+            # leave the rate baseline to the snapshot file
+            body = json.dumps(self.registry.snapshot(update=False)).encode("utf-8")
+            content_type = "application/json"
+        else:
+            body = self.registry.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host="127.0.0.1"):
+    """Serve /metrics (Prometheus text) and /metrics.json on a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("metrics: serving on http://{}:{}/metrics".format(host, server.server_address[1]))
+    return server
+
+
+def write_snapshots(path, interval=60.0):
+    """Append a JSON snapshot to path every interval seconds on a daemon thread."""
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path, "at") as f:
+                    f.write(json.dumps(registry.snapshot()) + "\n")
+            except Exception as e:
+                logger.error("metrics: could not write a snapshot to {}: {}".format(path, e))
+
+    thread = threading.Thread(target=loop, name="metrics-snapshots", daemon=True)
+    thread.start()
+    return thread
+
+
+def start(port=None, snapshot_file=None, interval=60.0):
+    """Turn on the HTTP endpoint and/or the JSON snapshots, whichever is given."""
+    server = serve(port) if port is not None else None
+    if snapshot_file:
+        write_snapshots(snapshot_file, interval)
+    return server
+
+
+def start_from_query(query):
+    # "metrics_port", "metrics_file" and "metrics_interval" in a query file
+    return start(query.get("metrics_port"), query.get("metrics_file"), query.get("metrics_interval", 60.0))
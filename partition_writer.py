@@ -0,0 +1,92 @@
+import logging
+import os
+import time
+
+import compression
+import metrics
+import serializer
+
+logger = logging.getLogger(__name__)
+
+
+class PartitionWriter:
+    """
+    Writes records to compressed JSONL partition files as they arrive, so a
+    job only ever holds the record it is writing in memory.
+
+    make_path(index) gives the final name of the index-th partition, which
+    should end in codec.extension (gzip when no codec is given). A
+    partition is written under that name plus ".tmp" and renamed once it is
+    full (lines_per_file records, or bytes_per_file bytes of uncompressed
+    JSON when set) or the writer is closed, so readers globbing for
+    "*.json.gz" never see a half written file. files lists the published
+    partitions.
+    """
+
+    def __init__(self, make_path, lines_per_file=10000, bytes_per_file=None, codec=None):
+        self.make_path = make_path
+        self.codec = codec or compression.get_codec()
+        self.lines_per_file = lines_per_file
+        self.bytes_per_file = bytes_per_file
+        self.files = []
+
+        self.index = 0
+        self.lines = 0
+        self.bytes = 0
+        self.total = 0
+        self.file_name = None
+        self.file_object = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self):
+        self.file_name = self.make_path(self.index)
+        self.file_object = self.codec.open(self.file_name + ".tmp", "wb")
+        self.lines = 0
+        self.bytes = 0
+
+    def _full(self):
+        if self.lines >= self.lines_per_file:
+            return True
+        return self.bytes_per_file is not None and self.bytes >= self.bytes_per_file
+
+    def write(self, record):
+        if self.file_object is None:
+            self._open()
+
+        started = time.perf_counter()
+        line = serializer.dumps_line(record, ensure_ascii=False)
+        metrics.SERIALIZE_SECONDS.observe(time.perf_counter() - started)
+        self.file_object.write(line)
+        self.lines += 1
+        self.bytes += len(line)
+        self.total += 1
+        metrics.TWEETS.inc()
+        metrics.BYTES_WRITTEN.inc(len(line))
+
+        if self._full():
+            self.rotate()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def rotate(self):
+        """Publish the open partition; the next write starts a new one."""
+        if self.file_object is None:
+            return
+        self.file_object.close()
+        os.rename(self.file_name + ".tmp", self.file_name)
+        print('writing to file', self.file_name)
+        logger.info("published {} ({} lines)".format(self.file_name, self.lines))
+
+        self.files.append(self.file_name)
+        self.file_object = None
+        self.index += 1
+
+    def close(self):
+        self.rotate()
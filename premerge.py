@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import zlib
+
+import compression
+import serializer
+
+logger = logging.getLogger(__name__)
+
+
+class PreMerger:
+    """
+    Merges the records of many tweet files by id before they are loaded, so
+    every tweet reaches the database once no matter how many files it was
+    re-emitted in.
+
+    The records are first spread over buckets files on disk by a hash of
+    their id, with the file they came from in source_files. Each bucket is
+    then merged in memory on its own: the first record read for an id is
+    kept and source_files collects every file it appeared in, in the order
+    they were read. Memory use is bounded by the largest bucket rather than
+    the whole input, so use more buckets for bigger inputs.
+
+    merge() returns the paths of the merged files. Each holds a disjoint set
+    of ids, so they can be loaded concurrently without conflicting.
+    """
+
+    def __init__(self, directory, buckets=64):
+        self.directory = directory
+        self.buckets = buckets
+        os.makedirs(directory, exist_ok=True)
+
+        self.records = 0
+        self.merged = 0
+
+    def bucket_path(self, index):
+        return os.path.join(self.directory, "bucket-{:05d}.jsonl".format(index))
+
+    def merged_path(self, index):
+        return os.path.join(self.directory, "merged-{:05d}.jsonl".format(index))
+
+    def partition(self, tweet_files, clean=None):
+        """Spread the records of tweet_files over the bucket files; clean(line) is applied to each line first."""
+        outputs = [open(self.bucket_path(i), "wb") for i in range(self.buckets)]
+        try:
+            for tweet_file in tweet_files:
+                with compression.open_input(tweet_file) as f:
+                    for line in f:
+                        data = json.loads(clean(line) if clean is not None else line)
+                        if "id" not in data:
+                            continue
+                        data["source_files"] = [tweet_file]
+                        tweet_id = str(data["id"])
+                        # not int(id) % buckets: the low bits of a snowflake id are mostly zero
+                        outputs[zlib.crc32(tweet_id.encode("utf-8")) % self.buckets].write(serializer.dumps_line(data))
+                        self.records += 1
+        finally:
+            for output in outputs:
+                output.close()
+
+    def merge_bucket(self, index):
+        merged = {}
+        with open(self.bucket_path(index), "rt", encoding="utf-8") as f:
+            for line in f:
+                data = json.loads(line)
+                tweet_id = str(data["id"])
+                first = merged.get(tweet_id)
+                if first is None:
+                    merged[tweet_id] = data
+                elif data["source_files"][0] not in first["source_files"]:
+                    first["source_files"].append(data["source_files"][0])
+        os.remove(self.bucket_path(index))
+
+        if not merged:
+            return None
+        path = self.merged_path(index)
+        with open(path + ".tmp", "wb") as f:
+            for data in merged.values():
+                f.write(serializer.dumps_line(data))
+        os.rename(path + ".tmp", path)
+        self.merged += len(merged)
+        return path
+
+    def merge(self, tweet_files, clean=None):
+        self.partition(tweet_files, clean)
+        paths = [path for path in (self.merge_bucket(i) for i in range(self.buckets)) if path is not None]
+        logger.info("pre-merged {} records from {} files into {} tweets".format(
+            self.records, len(tweet_files), self.merged))
+        return paths
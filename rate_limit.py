@@ -0,0 +1,259 @@
+import logging
+import re
+import threading
+import time
+from collections import deque, namedtuple
+
+import tweepy
+
+import api_utils
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# one entry per acquire() so callers can see why a request was (or was not) delayed
+PacingDecision = namedtuple("PacingDecision", ["at", "wait", "reason", "remaining", "reset_in", "rate"])
+
+
+class RateLimitGovernor:
+    """
+    Token bucket that paces requests using the x-rate-limit-remaining and
+    x-rate-limit-reset headers. The refill rate is whatever spreads the
+    remaining budget over the time left in the window, so requests go out as
+    fast as the budget allows and the window is never overrun.
+
+    min_interval enforces a hard floor between requests (the full archive
+    search only allows one request per second). headroom is the number of
+    requests to leave unused in each window as a safety margin. labels name
+    the token and endpoint in metrics.RATE_LIMIT_REMAINING.
+    """
+
+    def __init__(self, min_interval=0.0, burst=10, headroom=1, history=1000, clock=time.time, sleep=time.sleep,
+                 labels=None):
+        self.min_interval = min_interval
+        self.burst = burst
+        self.headroom = headroom
+        self.remaining = None
+        self.reset_at = None
+        self.rate = None
+        self.tokens = float(burst)
+        self.decisions = deque(maxlen=history)
+        self.labels = labels or {"token": "0", "endpoint": "default"}
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._last_refill = clock()
+        self._next_slot = 0.0
+
+    def update(self, headers, status_code=None):
+        """Feed the rate limit headers of a response back into the bucket."""
+        try:
+            remaining = int(headers.get("x-rate-limit-remaining"))
+            reset_at = int(headers.get("x-rate-limit-reset"))
+        except (TypeError, ValueError):
+            return False
+
+        if status_code == 429:
+            remaining = 0
+
+        with self._lock:
+            now = self._clock()
+            if self.rate:
+                # credit the refill since the last reservation before the rate changes
+                self.tokens += (now - self._last_refill) * self.rate
+            usable = max(remaining - self.headroom, 0)
+            self.remaining = remaining
+            self.reset_at = reset_at
+            self.rate = usable / max(reset_at - now, 1.0) if usable else None
+            self.tokens = min(self.tokens, float(max(1, min(self.burst, usable))))
+            self._last_refill = now
+        metrics.RATE_LIMIT_REMAINING.set(remaining, self.labels)
+        return True
+
+    def backoff(self, seconds):
+        """Treat the budget as spent for a while, e.g. after a 429 without headers."""
+        with self._lock:
+            self.remaining = 0
+            self.reset_at = self._clock() + seconds
+            self.rate = None
+
+    def _roll_window(self, now):
+        if self.reset_at is not None and now >= self.reset_at:
+            # new window; the next response will tell us the new budget
+            self.remaining = None
+            self.reset_at = None
+            self.rate = None
+            self.tokens = float(self.burst)
+
+    def _plan(self, now):
+        # returns (start time, reason, tokens left in the bucket) for a request made now
+        tokens = self.tokens
+        if self.remaining is not None and self.remaining <= self.headroom:
+            start, reason = self.reset_at + 1, "budget exhausted"
+        elif self.rate:
+            capacity = max(1, min(self.burst, self.remaining - self.headroom))
+            tokens = min(capacity, tokens + (now - self._last_refill) * self.rate) - 1
+            start, reason = now, "within budget"
+            if tokens < 0:
+                start, reason = now + (-tokens) / self.rate, "paced"
+        else:
+            start, reason = now, "unknown budget"
+
+        if start < self._next_slot:
+            start, reason = self._next_slot, "min interval"
+        return start, reason, tokens
+
+    def ready_at(self):
+        """When the next request could go out, without reserving it."""
+        with self._lock:
+            now = self._clock()
+            self._roll_window(now)
+            return self._plan(now)[0]
+
+    def exhausted(self):
+        with self._lock:
+            self._roll_window(self._clock())
+            return self.remaining is not None and self.remaining <= self.headroom
+
+    def reserve(self):
+        """Reserve the next request slot and return the decision without sleeping."""
+        with self._lock:
+            now = self._clock()
+            self._roll_window(now)
+            start, reason, self.tokens = self._plan(now)
+            self._last_refill = now
+            self._next_slot = start + self.min_interval
+
+            if self.remaining:
+                self.remaining -= 1
+
+            reset_in = self.reset_at - now if self.reset_at is not None else None
+            decision = PacingDecision(now, max(start - now, 0.0), reason, self.remaining, reset_in, self.rate)
+            self.decisions.append(decision)
+            return decision
+
+    def wait(self, decision):
+        if decision.wait > 0:
+            logger.debug("rate limit governor: waiting {:.2f} seconds ({})".format(decision.wait, decision.reason))
+            self._sleep(decision.wait)
+
+    def acquire(self):
+        """Block until the next request may be sent and return the decision that was made."""
+        decision = self.reserve()
+        self.wait(decision)
+        return decision
+
+    def stats(self):
+        waits = [d.wait for d in self.decisions]
+        reasons = {}
+        for d in self.decisions:
+            reasons[d.reason] = reasons.get(d.reason, 0) + 1
+        return {
+            "remaining": self.remaining,
+            "reset_at": self.reset_at,
+            "rate": self.rate,
+            "requests": len(waits),
+            "total_wait": sum(waits),
+            "max_wait": max(waits) if waits else 0.0,
+            "reasons": reasons,
+        }
+
+
+def route_key(route):
+    # /2/users/12345/tweets and /2/users/67890/tweets share the same limit
+    return re.sub(r"(?<!^)/\d+", "/:id", route)
+
+
+class TokenPool:
+    """
+    Spreads requests over several bearer tokens. Each token gets its own
+    governor per endpoint and every request goes to whichever token can send
+    soonest, so an exhausted token is skipped right away while the others
+    still have budget, and throughput grows with the number of tokens.
+    """
+
+    def __init__(self, bearer_tokens, min_interval=0.0, clock=time.time, sleep=time.sleep):
+        if not bearer_tokens:
+            raise ValueError("at least one bearer token is required")
+        self.bearer_tokens = list(bearer_tokens)
+        self.min_interval = min_interval
+        self.governors = {}  # keyed by (token index, route key)
+
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def __len__(self):
+        return len(self.bearer_tokens)
+
+    def governor(self, index, route):
+        key = (index, route_key(route))
+        if key not in self.governors:
+            self.governors[key] = RateLimitGovernor(min_interval=self.min_interval, clock=self._clock, sleep=self._sleep,
+                                                    labels={"token": str(index), "endpoint": key[1]})
+        return self.governors[key]
+
+    def reserve(self, route):
+        """Pick the token that can send soonest and reserve a slot on it."""
+        with self._lock:
+            count = len(self.bearer_tokens)
+            # start from a rotating offset so ties are spread round robin
+            order = [(self._next + i) % count for i in range(count)]
+            self._next = (self._next + 1) % count
+            index = min(order, key=lambda i: self.governor(i, route).ready_at())
+            governor = self.governor(index, route)
+            return index, governor, governor.reserve()
+
+    def acquire(self, route):
+        """Block until a token may send to route and return (bearer token, governor)."""
+        index, governor, decision = self.reserve(route)
+        governor.wait(decision)
+        return self.bearer_tokens[index], governor
+
+    def stats(self):
+        with self._lock:
+            # tokens are reported by position so they never end up in the logs
+            return {"token_%s %s" % key: governor.stats() for key, governor in self.governors.items()}
+
+
+class GovernedClient(tweepy.Client):
+    """
+    tweepy.Client that paces every request from the rate limit headers instead
+    of sleeping blindly (wait_on_rate_limit) or after every page. With several
+    bearer tokens, requests are spread over a TokenPool. Requests go through
+    the pooled session from api_utils.
+    """
+
+    def __init__(self, bearer_token=None, *args, bearer_tokens=None, min_interval=0.0, **kwargs):
+        kwargs["wait_on_rate_limit"] = False  # the governors take care of this
+        bearer_tokens = list(bearer_tokens or [bearer_token])
+        super().__init__(bearer_tokens[0], *args, **kwargs)
+        self.session = api_utils.make_session(pool_maxsize=max(api_utils.DEFAULT_POOL_MAXSIZE, len(bearer_tokens)))
+        self.pool = TokenPool(bearer_tokens, min_interval=min_interval)
+
+        # one plain client per token so concurrent requests never share a mutable token
+        self.clients = []
+        for token in bearer_tokens:
+            client = tweepy.Client(token, *args, **kwargs)
+            client.session = self.session
+            self.clients.append(client)
+
+    def pacing_stats(self):
+        return self.pool.stats()
+
+    def request(self, method, route, params=None, json=None, user_auth=False):
+        while True:
+            index, governor, decision = self.pool.reserve(route)
+            governor.wait(decision)
+            try:
+                response = self.clients[index].request(method, route, params=params, json=json, user_auth=user_auth)
+            except tweepy.TooManyRequests as e:
+                logger.warning("reached rate limit on {} with token {}, moving to the next token".format(route, index))
+                metrics.RETRIES.inc()
+                if not governor.update(e.response.headers, 429):
+                    governor.backoff(60)  # no reset time given, leave this token alone for a bit
+                continue
+            governor.update(response.headers, response.status_code)
+            return response
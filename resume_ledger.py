@@ -0,0 +1,138 @@
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+COMPLETED = "completed"
+FAILED = "failed"
+STATUSES = (COMPLETED, FAILED)
+
+ID_DTYPE = np.dtype("<i8")
+
+# written once seed_from_directory has imported every existing output
+SEEDED_MARKER = "seeded"
+
+# fold the in-memory set into the sorted array once it gets this big
+MERGE_THRESHOLD = 1000000
+
+
+class ResumeLedger:
+    """
+    Persistent record of the tweet ids a job has already finished, either
+    hydrated (completed) or reported as an error by the API (failed).
+
+    Each status is an append-only file of raw int64 ids. On startup the file
+    is read once into a sorted numpy array, so checking an id is a binary
+    search, memory is 8 bytes per id, and no directory listing is needed.
+    Ids added while running are appended to disk right away (made durable by
+    flush(), called after every chunk) and kept in a set that is folded into
+    the sorted array when it grows large.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.loaded = {}
+        self.recent = {}
+        self.files = {}
+        for status in STATUSES:
+            self.loaded[status] = self._load(status)
+            self.recent[status] = set()
+            self.files[status] = open(self._file_name(status), "ab")
+
+    @property
+    def seeded(self):
+        # not the .i64 files: the constructor creates those before seeding starts
+        return os.path.exists(os.path.join(self.path, SEEDED_MARKER))
+
+    def _file_name(self, status):
+        return os.path.join(self.path, "{}.i64".format(status))
+
+    def _load(self, status):
+        file_name = self._file_name(status)
+        if not os.path.exists(file_name):
+            return np.empty(0, dtype=ID_DTYPE)
+
+        with open(file_name, "rb") as f:
+            raw = f.read()
+
+        # drop a partial record left behind by a crash in the middle of a write
+        usable = len(raw) - len(raw) % ID_DTYPE.itemsize
+        ids = np.frombuffer(raw[:usable], dtype=ID_DTYPE)
+        unique = np.unique(ids)
+
+        # compact the file when it has picked up duplicates or a torn record
+        if len(unique) != len(ids) or usable != len(raw):
+            with open(file_name + ".tmp", "wb") as f:
+                unique.tofile(f)
+            os.replace(file_name + ".tmp", file_name)
+
+        logger.info("resume ledger: loaded {} {} ids".format(len(unique), status))
+        return unique
+
+    @staticmethod
+    def _to_int(tweet_id):
+        try:
+            return int(tweet_id)
+        except (TypeError, ValueError):
+            return None
+
+    def contains(self, tweet_id, status=None):
+        value = self._to_int(tweet_id)
+        if value is None:
+            return False
+
+        for s in (STATUSES if status is None else (status,)):
+            if value in self.recent[s]:
+                return True
+            loaded = self.loaded[s]
+            index = np.searchsorted(loaded, value)
+            if index < len(loaded) and loaded[index] == value:
+                return True
+        return False
+
+    def __contains__(self, tweet_id):
+        return self.contains(tweet_id)
+
+    def __len__(self):
+        return sum(len(self.loaded[s]) + len(self.recent[s]) for s in STATUSES)
+
+    def add(self, tweet_id, status=COMPLETED):
+        value = self._to_int(tweet_id)
+        if value is None or self.contains(value, status):
+            return
+        self.recent[status].add(value)
+        self.files[status].write(np.array([value], dtype=ID_DTYPE).tobytes())
+
+        if len(self.recent[status]) >= MERGE_THRESHOLD:
+            recent = np.fromiter(self.recent[status], dtype=ID_DTYPE, count=len(self.recent[status]))
+            self.loaded[status] = np.union1d(self.loaded[status], recent)
+            self.recent[status] = set()
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+    def seed_from_directory(self, directory, suffix=".json"):
+        """One time import of the outputs a job wrote before it had a ledger."""
+        count = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(suffix):
+                    self.add(entry.name.split(".", 1)[0], COMPLETED)
+                    count = count + 1
+        self.flush()
+        # only now: a seed cut short is started again on the next run (add skips ids already there)
+        with open(os.path.join(self.path, SEEDED_MARKER), "wt") as f:
+            f.write("{}\n".format(count))
+        logger.info("resume ledger: imported {} existing outputs from {}".format(count, directory))
+        return count
@@ -1,14 +1,21 @@
 import argparse
-import gzip
 import json
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import numpy as np
 import tweepy
 
+import compression
+import metrics
+from api_utils import get_bearer_tokens
+from partition_writer import PartitionWriter
+from rate_limit import GovernedClient
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer, response_parts
+
 logging.captureWarnings(True)
 logger = logging.getLogger(__name__)
 from logging.handlers import RotatingFileHandler
@@ -24,178 +31,54 @@ def get_json(file_name):
         jobj = json.load(f)
         return jobj
 
-def get_API(credentials):
-    client = tweepy.Client(bearer_token=credentials['bearer_token'], wait_on_rate_limit=True)
+def get_API(credentials, raw=False):
+    # requests are paced from the rate limit headers and spread over every bearer token we have;
+    # full archive search allows one request per second
+    # raw=True returns the decoded JSON pages as they are, without building tweepy models
+    return_type = dict if raw else tweepy.Response
+    client = GovernedClient(bearer_tokens=get_bearer_tokens(credentials), min_interval=1.0, return_type=return_type)
     return client
 
 
-def get_hashtags(entities):
-    if not entities:
-        return
-
-    hashtags = entities.get('hashtags')
-    if not hashtags:
-        return
-
-    hlst = []
-    for h in hashtags:
-        hlst.append(h['tag'])
-
-    return hlst
-
-def get_expanded_urls(entities):
-    if not entities:
-        return
-
-    urls = entities.get('urls')
-    if not urls:
-        return
-
-    ulst = []
-    for h in urls:
-        ulst.append(h['expanded_url'])
-
-    return ulst
-
-def get_media_view_count(media):
-    if 'public_metrics' not in media:
-        return
-    return media.get("public_metrics").get("view_count", None)
-
-def parse_ref_tweet(tweet, users):
-    # print('>>>>>>>>>>>>>>>. ref tweet', tweet.data)
-    obj = {
-        "id": tweet["id"],
-        "conversation_id": tweet["conversation_id"],
-        "created_at": tweet["created_at"],
-        "tweet": tweet["text"],
-        "hashtags": get_hashtags(tweet.get('entities')),
-        "urls": get_expanded_urls(tweet.get('entities')),
-        "source": tweet.get("source", None),
-        "language": tweet["lang"],
-        "retweet_count": tweet["public_metrics"]["retweet_count"],
-        "reply_count": tweet["public_metrics"]["reply_count"],
-        "like_count": tweet["public_metrics"]["like_count"],
-        "quote_count": tweet["public_metrics"]["quote_count"],
-        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-        "possibly_sensitive": tweet["possibly_sensitive"],
-        "reply_settings": tweet["reply_settings"],
-    }
+normalizer = TweetNormalizer(FULL_FIELDS)
 
-    author = users.get(tweet["author_id"])  # get user object
-    # print('ref author is', author)
-    if author:
-        obj.update({
-            "user_id": tweet["author_id"],
-            "user_screen_name": author["username"],
-            "user_name": author["name"],
-            "user_description": author["description"],
-            "user_location": author.get("location"),
-            "user_created_at": author["created_at"],
-            "user_followers_count": author["public_metrics"]["followers_count"],
-            "user_friends_count": author["public_metrics"]["following_count"],
-            "user_statuses_count": author["public_metrics"]["tweet_count"],
-            "user_verified": author["verified"]
-        })
-    return obj
-
-def parse_tweet(tweet, users, **kwargs):
-    author = users.get(tweet["author_id"])  # get user object
-    obj = {
-        "id": tweet["id"],
-        "conversation_id": tweet["conversation_id"],
-        "created_at": tweet["created_at"],
-        "tweet": tweet["text"],
-        "entities": tweet.entities,
-        # "hashtags": [x.get("tag") for x in tweet.get("entities", {}).get("hashtags", [{}])],
-        # "urls": [x["expanded_url"] for x in tweet.get("entities", {}).get("urls", [])],
-        "hashtags": get_hashtags(tweet.get('entities')),
-        "urls": get_expanded_urls(tweet.get('entities')),
-        "source": tweet.get("source", None),
-        "language": tweet["lang"],
-        "retweet_count": tweet["public_metrics"]["retweet_count"],
-        "reply_count": tweet["public_metrics"]["reply_count"],
-        "like_count": tweet["public_metrics"]["like_count"],
-        "quote_count": tweet["public_metrics"]["quote_count"],
-        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-        "possibly_sensitive": tweet["possibly_sensitive"],
-        "reply_settings": tweet["reply_settings"],
-
-        "user_id": tweet["author_id"],
-        "user_screen_name": author["username"],
-        "user_name": author["name"],
-        "user_description": author["description"],
-        "user_location": author.get("location"),
-        "user_created_at": author["created_at"],
-        "user_followers_count": author["public_metrics"]["followers_count"],
-        "user_friends_count": author["public_metrics"]["following_count"],
-        "user_statuses_count": author["public_metrics"]["tweet_count"],
-        "user_verified": author["verified"],
-
-        "references": tweet.get("referenced_tweets"),
-        "context_annotations": tweet.get("context_annotations", None),
-    }
+def log_parse_error(tweet, e):
+    print(">>>>>Error Parsing Tweet", e, getattr(tweet, "data", tweet))
+    logger.error("error=%s, tweet=%s"%(e, getattr(tweet, "data", tweet)))
+    traceback.print_exc()
 
-    if kwargs['includes_tweets']:
-        includes_tweets = kwargs['includes_tweets']
-        if tweet['referenced_tweets']:
-            ref_tweets = tweet.get("referenced_tweets")
-            for ref_tweet_dict in ref_tweets:
-                if ref_tweet_dict['id'] in includes_tweets:
-                    ref_tweet_obj = parse_ref_tweet(includes_tweets[ref_tweet_dict['id']], users)
-                    type = ref_tweet_dict['type']
-                    obj['references_%s'%type] = ref_tweet_obj
-
-    if kwargs['includes_media']:
-        includes_media = kwargs['includes_media']
-        if "attachments" in tweet and "media_keys" in tweet['attachments']:
-            media_keys = tweet['attachments']['media_keys']
-            mobjs = []
-            for media_key in media_keys:
-                media = includes_media.get(media_key)
-                if not media:
-                    continue
-                # print('>>>>>>>>>>>>>media', media.data, media.get("public_metrics", {}))
-                mobj = {
-                    "media_key": media["media_key"],
-                    "media_type": media["type"],
-                    "media_view_count": get_media_view_count(media),
-                    "media_height": media.get("height"),
-                    "media_width": media.get("width"),
-                    "media_url": media.get("url"),
-                    "media_preview_image_url": media.get("preview_image_url"),
-                    "media_variants":media.get("variants"),
-                    "media_alt_text": media.get("alt_text")
-                }
-                mobjs.append(mobj)
-            obj['media_objects'] = mobjs
-    return obj
-
-def write_to_file(results, output, timestamp, job_name, partition_idx):
-    write_file = os.path.join(output, "%s_partition_%s_%s.json.gz" % (job_name, partition_idx, timestamp))
-    print('writing to file', write_file)
-    with gzip.open(write_file, "wt") as f:
-        for tweet in results:
-            f.write(json.dumps(tweet, default=str, ensure_ascii=False) + "\n")
-    return
+def open_writer(query, output, timestamp, job_name):
+    # tweets are written out as they are parsed and partitions are published as they fill up
+    codec = compression.codec_from_query(query)
+    def make_path(partition_idx):
+        return os.path.join(output, "%s_partition_%s_%s.json%s" % (job_name, partition_idx, timestamp, codec.extension))
+    return PartitionWriter(make_path, lines_per_file=query.get('lines_per_file', 10000),  # for testing
+                           bytes_per_file=query.get('bytes_per_file'), codec=codec)
 
 import traceback
-def get_tweets(credentials, query, output, tweet_fields_, user_fields_, expand_fields_, place_fields_, media_fields_):
-    api = get_API(credentials)
+def get_tweets(credentials, query, output, tweet_fields_, user_fields_, expand_fields_, place_fields_, media_fields_, api=None,
+               writer=None, page_normalizer=None):
+    # a shared client can be passed in so parallel slices draw from the same rate limit budget,
+    # a writer (anything with write, close and files) to send the tweets somewhere other than output,
+    # and a normalizer so the records match those of another script writing to the same files
+    page_normalizer = page_normalizer or normalizer
+    shared_api = api is not None
+    raw = query.get('raw_responses', False)
+    if not shared_api:
+        api = get_API(credentials, raw)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S.%f")
 
-    lines_per_file = query.get('lines_per_file', 10000) #for testing
-    max_users = query.get('max_users', np.Inf)
+    max_users = query.get('max_users', np.inf)
     pagination_token = query.get("pagination_token", None)
     job_name = query.get('name', 'default')
 
-    partition_idx = 0
+    if writer is None:
+        writer = open_writer(query, output, timestamp, job_name)
     unique_users = set()
     max_retries = 3
     retry_count = 0
     while True:
         try:
-            results = []
             responses = tweepy.Paginator(api.search_all_tweets,
                                          query=query['query'],
                                          pagination_token=pagination_token,
@@ -210,55 +93,23 @@ def get_tweets(credentials, query, output, tweet_fields_, user_fields_, expand_f
                                          limit=query['max_pages']  # max number of pages to return
                                          )
 
-            for resp in responses:  # loop through each tweepy.Response field
-                if resp is None or resp.data is None:
+            for resp in responses:  # loop through each tweepy.Response (or raw JSON page)
+                if resp is None:
+                    break
+                data, _, meta = response_parts(resp)
+                if data is None:
                     break
-                if "next_token" in resp.meta:
-                    pagination_token = resp.meta['next_token']
-                else:
-                    pagination_token = None
+                pagination_token = meta.get('next_token')
 
                 logger.info("pagination_token=%s"%pagination_token)
                 print("pagination_token=%s"%pagination_token)
 
-                # get all the users from includes
-                users = {}  # keyed by user id
-                for user in resp.includes['users']:
-                    user_id = user["id"]
-                    users[user_id] = user
-
-                includes_media = {}
-                if 'media' in resp.includes:
-                    for media in resp.includes['media']:
-                        media_key = media['media_key']
-                        includes_media[media_key] = media
-
-                # extract include tweets
-                includes_tweets = {}
-                if "tweets" in resp.includes:
-                    tlist = resp.includes['tweets']
-                    for tweet in tlist:
-                        includes_tweets[tweet.id] = tweet
-
-                #TODO probably needs to include logic for place/location too
-
-                # loop through regular tweets
-                tweets = resp.data
-                for tweet in tweets:
-                    try:
-                        obj = parse_tweet(tweet, users, includes_tweets=includes_tweets, includes_media=includes_media)
-                        unique_users.add(obj['user_id'])
-                        results.append(obj)
-                    except Exception as e:
-                        print(">>>>>Error Parsing Tweet", e, tweet.data)
-                        logger.error("error=%s, tweet=%s"%(e, tweet.data))
-                        traceback.print_exc()
-
-                #write to file
-                if len(results)>= lines_per_file:
-                    write_to_file(results, output, timestamp, job_name, partition_idx)
-                    results = []
-                    partition_idx +=1
+                # parse the whole page in one go
+                with metrics.PARSE_SECONDS.time():
+                    objs = page_normalizer.normalize_page(resp, on_error=log_parse_error)
+                for obj in objs:
+                    unique_users.add(obj['user_id'])
+                    writer.write(obj)
 
                 #break if we got all the users we need
                 print('number of unique users', len(unique_users))
@@ -267,27 +118,134 @@ def get_tweets(credentials, query, output, tweet_fields_, user_fields_, expand_f
 
                 #reset retry after each successful fetch
                 retry_count = 0
-                time.sleep(1) #rate limit
 
-            #write the remaining results
-            if len(results)>0:
-                write_to_file(results, output, timestamp, job_name, partition_idx)
-            break
+            #publish the last partition
+            writer.close()
+            logger.info("rate limit pacing=%s"%api.pacing_stats())
+            return {"files": writer.files, "complete": True, "pagination_token": pagination_token}
         except Exception as e:
             print('>>>>>>>>>>>>>>>>>>>>>Error', e)
             logger.error("error=%s"%(e))
             if retry_count>=max_retries:
-                return
+                writer.close()
+                return {"files": writer.files, "complete": False, "pagination_token": pagination_token}
             retry_count+=1
+            metrics.RETRIES.inc()
             time.sleep(60 * (retry_count+1))
-            api = get_API(credentials)
+            if not shared_api:
+                api = get_API(credentials, raw)
             continue
 
+def to_api_time(timestamp):
+    # the counts endpoint returns "2022-10-01T00:00:00.000Z", search wants "2022-10-01T00:00:00Z"
+    return timestamp[:19] + "Z"
+
+def get_tweet_counts(api, query, granularity):
+    counts = []
+    responses = tweepy.Paginator(api.get_all_tweets_count,
+                                 query=query['query'],
+                                 start_time=query['start_time'],
+                                 end_time=query['end_time'],
+                                 granularity=granularity)
+    for resp in responses:
+        if resp is None:
+            break
+        data, _, _ = response_parts(resp)
+        if data is None:
+            break
+        counts.extend(data)
+    return sorted(counts, key=lambda c: c['start'])
+
+def split_by_volume(counts, start_time, end_time, num_slices):
+    """Cut [start_time, end_time) into at most num_slices windows holding roughly equal numbers of tweets."""
+    total = sum(c['tweet_count'] for c in counts)
+    if num_slices <= 1 or total == 0:
+        return [(start_time, end_time, total)]
+
+    slices = []
+    slice_start = start_time
+    slice_count = 0
+    assigned = 0
+    for c in counts:
+        slice_count += c['tweet_count']
+        boundary = to_api_time(c['end'])
+        # share what is left evenly between the remaining slices, so one heavy bucket
+        # does not leave a string of tiny slices behind it
+        target = (total - assigned) / (num_slices - len(slices))
+        if slice_count >= target and len(slices) < num_slices - 1 and boundary < end_time:
+            slices.append((slice_start, boundary, slice_count))
+            assigned += slice_count
+            slice_start = boundary
+            slice_count = 0
+    slices.append((slice_start, end_time, slice_count))
+    return slices
+
+def write_manifest(manifest, output, job_name, timestamp):
+    manifest_file = os.path.join(output, "%s_manifest_%s.json" % (job_name, timestamp))
+    with open(manifest_file + ".tmp", "wt") as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(manifest_file + ".tmp", manifest_file)
+    return manifest_file
+
+def get_tweets_parallel(credentials, query, output, tweet_fields_, user_fields_, expand_fields_, place_fields_, media_fields_):
+    """
+    Use the counts endpoint to split the search window into slices of about
+    the same tweet volume, then paginate the slices concurrently. Each slice
+    writes its own partition files and a manifest lists them all.
+    """
+    api = get_API(credentials, query.get('raw_responses', False))
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S.%f")
+    job_name = query.get('name', 'default')
+    num_slices = query['parallel_slices']
+    granularity = query.get('counts_granularity', 'day')
+
+    counts = get_tweet_counts(api, query, granularity)
+    slices = split_by_volume(counts, query['start_time'], query['end_time'], num_slices)
+    print('split search into %s slices' % len(slices))
+    logger.info("split search into %s slices=%s" % (len(slices), slices))
+
+    manifest = {
+        "name": job_name,
+        "query": query['query'],
+        "start_time": query['start_time'],
+        "end_time": query['end_time'],
+        "granularity": granularity,
+        "expected_tweets": sum(c['tweet_count'] for c in counts),
+        "slices": [],
+    }
+    with ThreadPoolExecutor(max_workers=query.get('parallel_workers', len(slices))) as executor:
+        futures = {}
+        for idx, (start, end, expected) in enumerate(slices):
+            slice_query = dict(query, start_time=start, end_time=end, name="%s_slice_%s" % (job_name, idx))
+            slice_query.pop('pagination_token', None)
+            future = executor.submit(get_tweets, credentials, slice_query, output, tweet_fields_, user_fields_,
+                                     expand_fields_, place_fields_, media_fields_, api=api)
+            futures[future] = {"slice": idx, "start_time": start, "end_time": end, "expected_tweets": expected}
+
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error("slice=%s, error=%s" % (entry['slice'], e))
+                result = {"files": [], "complete": False, "pagination_token": None}
+            entry.update(result)
+            entry['files'] = [os.path.basename(f) for f in entry['files']]
+            manifest['slices'].append(entry)
+            logger.info("finished slice=%s" % entry)
+
+    manifest['slices'].sort(key=lambda e: e['slice'])
+    manifest_file = write_manifest(manifest, output, job_name, timestamp)
+    print('wrote manifest', manifest_file)
+    logger.info("rate limit pacing=%s" % api.pacing_stats())
+    return manifest
+
 def batch_fetch(credentials_file, query_file, output):
     credentials = get_json(credentials_file)
     query = get_json(query_file)
     print(query)
     logger.info('query=%s'%query)
+    metrics.start_from_query(query)
 
     user_fields = "created_at,description,entities,id,location,name,protected,public_metrics,url,username,verified,withheld"
     user_fields = query.get('user_fields', user_fields)
@@ -314,7 +272,10 @@ def batch_fetch(credentials_file, query_file, output):
     print('place_fields', place_fields)
     print('media_fields', media_fields)
 
-    get_tweets(credentials, query, output, tweet_fields, user_fields, expansion_fields, place_fields, media_fields)
+    if query.get('parallel_slices', 1) > 1:
+        get_tweets_parallel(credentials, query, output, tweet_fields, user_fields, expansion_fields, place_fields, media_fields)
+    else:
+        get_tweets(credentials, query, output, tweet_fields, user_fields, expansion_fields, place_fields, media_fields)
     return
 
 def api_test():
@@ -0,0 +1,153 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SPL1"
+# magic, unused, read offset
+HEADER = struct.Struct("<4sIQ")
+LENGTH = struct.Struct("<I")
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class Segment:
+    """
+    One memory-mapped file of length-prefixed records. The header keeps the
+    offset of the next unread record, so a restart picks up where the
+    previous run stopped. The payload is written before its length, and a
+    zero length marks the end, so a record is either complete or absent.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        exists = os.path.exists(path)
+        self.file = open(path, "r+b" if exists else "w+b")
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        if exists:
+            magic, _, self.read_offset = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError("{} is not a spill segment".format(path))
+            self.write_offset, self.count = self._scan(self.read_offset)
+        else:
+            HEADER.pack_into(self.map, 0, MAGIC, 0, HEADER.size)
+            self.read_offset = self.write_offset = HEADER.size
+            self.count = 0
+
+    def _scan(self, offset):
+        # find the end of the written records, counting the unread ones on the way
+        count = 0
+        while offset + LENGTH.size <= self.size:
+            (length,) = LENGTH.unpack_from(self.map, offset)
+            if length == 0:
+                break
+            offset += LENGTH.size + length
+            count += 1
+        return offset, count
+
+    def fits(self, length):
+        # leave room for the zero length that marks the end
+        return self.write_offset + 2 * LENGTH.size + length <= self.size
+
+    def append(self, data):
+        start = self.write_offset + LENGTH.size
+        self.map[start:start + len(data)] = data
+        LENGTH.pack_into(self.map, self.write_offset, len(data))
+        self.write_offset = start + len(data)
+        self.count += 1
+
+    def pop(self):
+        if self.read_offset >= self.write_offset:
+            return None
+        (length,) = LENGTH.unpack_from(self.map, self.read_offset)
+        start = self.read_offset + LENGTH.size
+        data = self.map[start:start + length]
+        self.read_offset = start + length
+        HEADER.pack_into(self.map, 0, MAGIC, 0, self.read_offset)
+        self.count -= 1
+        return data
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+
+class SpillLog:
+    """
+    Append-only on-disk log of raw records, used to absorb bursts that the
+    in-memory queue cannot hold. Records are appended to memory-mapped
+    segment files of segment_size bytes (bigger for a record that does not
+    fit) and popped in the order they were appended. A segment is deleted
+    once it has been read to the end and a newer one exists. Unread records
+    left over from a previous run are read first.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        self.appended = 0
+        self.popped = 0
+        self._lock = threading.Lock()
+
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+        self.segments = [Segment(os.path.join(directory, name)) for name in names]
+        self._next_index = int(names[-1].split(".")[0]) + 1 if names else 0
+        if self.segments:
+            logger.info("spill log: found {} unread records in {} segments".format(len(self), len(self.segments)))
+
+    def _new_segment(self, length):
+        size = max(self.segment_size, HEADER.size + 2 * LENGTH.size + length)
+        path = os.path.join(self.directory, "{:012d}.seg".format(self._next_index))
+        self._next_index += 1
+        segment = Segment(path, size)
+        self.segments.append(segment)
+        return segment
+
+    def append(self, data):
+        with self._lock:
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or not segment.fits(len(data)):
+                segment = self._new_segment(len(data))
+            segment.append(data)
+            self.appended += 1
+
+    def pop(self):
+        """The oldest unread record, or None when the log has been read to the end."""
+        with self._lock:
+            while self.segments:
+                segment = self.segments[0]
+                data = segment.pop()
+                if data is not None:
+                    self.popped += 1
+                    return data
+                if len(self.segments) == 1:
+                    return None
+                # read to the end and no longer written to
+                segment.close()
+                os.remove(segment.path)
+                self.segments.pop(0)
+            return None
+
+    def __len__(self):
+        return sum(segment.count for segment in self.segments)
+
+    def flush(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.map.flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
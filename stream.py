@@ -1,5 +1,4 @@
 import argparse
-import gzip
 import json
 import logging
 import os
@@ -8,10 +7,21 @@ import traceback
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 import atexit
+import threading
+from collections import deque
+from datetime import timedelta, timezone
 
 import tenacity
 from tweepy import StreamingClient, StreamRule
 
+import api_utils
+import compression
+import metrics
+import serializer
+from background_writer import BackgroundWriter
+from spill_log import SpillLog
+from tweet_normalizer import FULL_FIELDS, TweetNormalizer
+
 # set logging
 logging.captureWarnings(True)
 LOGGER_NAME = "twitter-streamer"
@@ -22,178 +32,59 @@ log_handler2.setFormatter(logging.Formatter("%(asctime)s %(levelname)-8s - %(mes
 logger.addHandler(log_handler2)
 logger.setLevel(logging.INFO)  # TODO can change this te DEBUG
 
+STATE_FILE = ".stream_state.json"
 
-def get_hashtags(entities):
-    if not entities:
-        return
-
-    hashtags = entities.get('hashtags')
-    if not hashtags:
-        return
-
-    hlst = []
-    for h in hashtags:
-        hlst.append(h['tag'])
-
-    return hlst
-
-
-def get_expanded_urls(entities):
-    if not entities:
-        return
+# how many recent tweet ids to remember so backfilled tweets are not written twice
+DEDUP_WINDOW = 200000
 
-    urls = entities.get('urls')
-    if not urls:
-        return
+# full archive search wants end_time at least SEARCH_LAG seconds in the past; wait BACKFILL_DELAY
+# seconds after a reconnect so the backfill window can run past the moment the stream came back
+SEARCH_LAG = 10
+BACKFILL_DELAY = 30
 
-    ulst = []
-    for h in urls:
-        ulst.append(h['expanded_url'])
 
-    return ulst
+def to_api_time(value):
+    # "2022-10-01T12:00:00.000Z" or a datetime -> "2022-10-01T12:00:00Z"
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def get_media_view_count(media):
-    if 'public_metrics' not in media:
-        return
-    return media.get("public_metrics").get("view_count", None)
+class BackfillWriter:
+    """
+    Hands the tweets a backfill search finds to the streamer's writer thread.
+    Tweets older than the last one on disk (by id) were already received
+    before the gap and are skipped.
+    """
 
+    def __init__(self, writer, after_id=None):
+        self.writer = writer
+        self.after_id = int(after_id) if after_id is not None else None
+        self.files = []
+        self.total = 0
 
-def parse_ref_tweet(tweet, users):
-    # print('>>>>>>>>>>>>>>>. ref tweet', tweet.data)
-    obj = {
-        "id": tweet["id"],
-        "conversation_id": tweet["conversation_id"],
-        "created_at": tweet["created_at"],
-        "tweet": tweet["text"],
-        "hashtags": get_hashtags(tweet.get('entities')),
-        "urls": get_expanded_urls(tweet.get('entities')),
-        "source": tweet.get("source", None),
-        "language": tweet["lang"],
-        "retweet_count": tweet["public_metrics"]["retweet_count"],
-        "reply_count": tweet["public_metrics"]["reply_count"],
-        "like_count": tweet["public_metrics"]["like_count"],
-        "quote_count": tweet["public_metrics"]["quote_count"],
-        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-        "possibly_sensitive": tweet["possibly_sensitive"],
-        "reply_settings": tweet["reply_settings"],
-    }
-
-    author = users.get(tweet["author_id"])  # get user object
-    # print('ref author is', author)
-    if author:
-        obj.update({
-            "user_id": tweet["author_id"],
-            "user_screen_name": author["username"],
-            "user_name": author["name"],
-            "user_description": author["description"],
-            "user_location": author.get("location"),
-            "user_created_at": author["created_at"],
-            "user_followers_count": author["public_metrics"]["followers_count"],
-            "user_friends_count": author["public_metrics"]["following_count"],
-            "user_statuses_count": author["public_metrics"]["tweet_count"],
-            "user_verified": author["verified"]
-        })
-    return obj
-
-
-def parse_tweet(tweet, users, **kwargs):
-    author = users.get(tweet["author_id"])  # get user object
-    obj = {
-        "id": tweet["id"],
-        "conversation_id": tweet["conversation_id"],
-        "created_at": tweet["created_at"],
-        "tweet": tweet["text"],
-        "entities": tweet.entities,
-        # "hashtags": [x.get("tag") for x in tweet.get("entities", {}).get("hashtags", [{}])],
-        # "urls": [x["expanded_url"] for x in tweet.get("entities", {}).get("urls", [])],
-        "hashtags": get_hashtags(tweet.get('entities')),
-        "urls": get_expanded_urls(tweet.get('entities')),
-        "source": tweet.get("source", None),
-        "language": tweet["lang"],
-        "retweet_count": tweet["public_metrics"]["retweet_count"],
-        "reply_count": tweet["public_metrics"]["reply_count"],
-        "like_count": tweet["public_metrics"]["like_count"],
-        "quote_count": tweet["public_metrics"]["quote_count"],
-        "in_reply_to_user_id": tweet.get("in_reply_to_user_id", None),
-        "possibly_sensitive": tweet["possibly_sensitive"],
-        "reply_settings": tweet["reply_settings"],
-
-        "user_id": tweet["author_id"],
-        "user_screen_name": author["username"],
-        "user_name": author["name"],
-        "user_description": author["description"],
-        "user_location": author.get("location"),
-        "user_created_at": author["created_at"],
-        "user_followers_count": author["public_metrics"]["followers_count"],
-        "user_friends_count": author["public_metrics"]["following_count"],
-        "user_statuses_count": author["public_metrics"]["tweet_count"],
-        "user_verified": author["verified"],
-
-        "references": tweet.get("referenced_tweets"),
-        "context_annotations": tweet.get("context_annotations", None),
-    }
+    def write(self, record):
+        if self.after_id is not None and int(record["id"]) <= self.after_id:
+            return
+        self.writer.put(record, spill=False, block=True)
+        self.total += 1
 
-    if kwargs['includes_tweets']:
-        includes_tweets = kwargs['includes_tweets']
-        if tweet['referenced_tweets']:
-            ref_tweets = tweet.get("referenced_tweets")
-            for ref_tweet_dict in ref_tweets:
-                if ref_tweet_dict['id'] in includes_tweets:
-                    ref_tweet_obj = parse_ref_tweet(includes_tweets[ref_tweet_dict['id']], users)
-                    type = ref_tweet_dict['type']
-                    obj['references_%s' % type] = ref_tweet_obj
-
-    if kwargs['includes_media']:
-        includes_media = kwargs['includes_media']
-        if "attachments" in tweet and "media_keys" in tweet['attachments']:
-            media_keys = tweet['attachments']['media_keys']
-            mobjs = []
-            for media_key in media_keys:
-                media = includes_media.get(media_key)
-                if not media:
-                    continue
-                # print('>>>>>>>>>>>>>media', media.data, media.get("public_metrics", {}))
-                mobj = {
-                    "media_key": media["media_key"],
-                    "media_type": media["type"],
-                    "media_view_count": get_media_view_count(media),
-                    "media_height": media.get("height"),
-                    "media_width": media.get("width"),
-                    "media_url": media.get("url"),
-                    "media_preview_image_url": media.get("preview_image_url"),
-                    "media_variants": media.get("variants"),
-                    "media_alt_text": media.get("alt_text")
-                }
-                mobjs.append(mobj)
-            obj['media_objects'] = mobjs
-
-    if kwargs['includes_places']:
-        includes_places = kwargs['includes_places']
-        if (tweet.geo is not None) and ('place_id' in tweet.geo):
-            place_id = tweet.geo['place_id']
-            if place_id in includes_places:
-                place = includes_places[place_id]
-                pobj = {
-                    "id": place.id,
-                    'full_name': place.full_name,
-                    "contained_within": place.contained_within,
-                    "country": place.country,
-                    "country_code": place.country_code,
-                    'geo': place.geo,
-                    "name": place.name,
-                    "place_type": place.place_type
-                }
-                obj['place_object'] = pobj
-
-    return obj
+    def close(self):
+        pass
 
 
 class TwitterStreamer(StreamingClient):
-    def __init__(self, bearer_token, limit, output_dir, *args, **kwargs):
+    def __init__(self, bearer_token, limit, output_dir, *args, raw=False, writer_options=None, codec=None,
+                 backfill=None, **kwargs):
         super().__init__(bearer_token, *args, **kwargs)
         self.logger = logging.getLogger(LOGGER_NAME)
 
+        # honours TWITTER_API_BASE_URL, so the streamer can be pointed at a local stand-in
+        self.session = api_utils.APISession()
+        self.session.headers["User-Agent"] = self.user_agent
+
         self.lines = 0
         self.lines_per_file = 10000  # Replace this with the number of tweets you want to store per file
 
@@ -208,78 +99,111 @@ class TwitterStreamer(StreamingClient):
         self.file_path = output_dir
         self.file_name = None
         self.file_object = None
+        self.codec = codec or compression.get_codec()
+        self.extension = self.codec.extension
+
+        self.normalizer = TweetNormalizer(FULL_FIELDS, places=True)
+
+        # normalize the decoded JSON directly instead of building tweepy models first
+        self.raw = raw
+
+        # backfill(start_time, end_time, writer, normalizer) searches for the tweets sent while we were disconnected
+        self.backfill = backfill
+        self.backfill_lock = threading.Lock()
+        self.state_file = os.path.join(output_dir, STATE_FILE)
+        # the newest tweet written so far, loaded from the state file on a restart
+        self.last_id, self.last_created_at = self.load_state()
+        self.seen_ids = set()
+        self.seen_order = deque()
+        self.duplicates = 0
+
+        # the thread reading the stream only queues the raw data; parsing and writing happen on the writer thread
+        self.writer = BackgroundWriter(self.process_data, self.flush_file, name="stream-writer",
+                                       **(writer_options or {})).start()
+        metrics.WRITER_QUEUE_DEPTH.callback = self.writer.depth
+        self.connections = 0
 
         atexit.register(self.on_exit)  # run this when exiting
 
-    def _extract_one(self, tweet, users, **kwargs):
-        return parse_tweet(tweet, users, **kwargs)
+    def on_data(self, raw_data):
+        self.writer.put(raw_data)
+
+    def process_data(self, raw_data):
+        if isinstance(raw_data, dict):
+            # already normalized by a backfill search
+            return self.save_data_self(raw_data)
+        if not self.raw:
+            return super().on_data(raw_data)
+
+        response = json.loads(raw_data)
+        if response.get("errors"):
+            self.on_errors(response["errors"])
+        if "data" not in response:
+            return
+
+        try:
+            with metrics.PARSE_SECONDS.time():
+                jobjs = self.normalizer.normalize_page(response)
+        except Exception as e:
+            logger.info(f'tweet is {response["data"]}')
+            raise e
+
+        for jobj in jobjs:
+            self.save_data_self(jobj)
 
     def on_response(self, response):
         if response.errors:
             logger.info(response.errors)
 
-        # step1: process includes
-        includes = response.includes
-
-        # extract users
-        includes_users = {}
-        if "users" in includes:
-            ulist = includes['users']
-            for user in ulist:
-                includes_users[user.id] = user
-        # print('includes_users', includes_users)
-
-        # extract places
-        includes_places = {}
-        if 'places' in includes:
-            plist = includes['places']
-            for place in plist:
-                includes_places[place.id] = place
-        # print('includes_places', includes_places)
-
-        includes_media = {}
-        if 'media' in includes:
-            for media in includes['media']:
-                media_key = media['media_key']
-                includes_media[media_key] = media
-
-        # extract include tweets (these are the reference tweets)
-        includes_tweets = {}
-        if "tweets" in includes:
-            tlist = includes['tweets']
-            for tweet in tlist:
-                includes_tweets[tweet.id] = tweet
-
-        # step2: process actual tweets
-        tweet = response.data
-        if tweet:
-            try:
-                logger.debug(f'tweet is {tweet}')
-                jobj = self._extract_one(tweet, includes_users, includes_tweets=includes_tweets,
-                                         includes_media=includes_media, includes_places=includes_places)
-                self.save_data_self(jobj)
-            except Exception as e:
-                logger.info(f'tweet is {tweet}')
-                raise e
+        # the response holds one tweet plus the users, tweets, media and places it references
+        try:
+            with metrics.PARSE_SECONDS.time():
+                jobjs = self.normalizer.normalize_page(response)
+        except Exception as e:
+            logger.info(f'tweet is {response.data}')
+            raise e
+
+        for jobj in jobjs:
+            self.save_data_self(jobj)
+
+    def remember(self, tweet_id):
+        """False if the tweet was written recently, otherwise note that it is being written now."""
+        if tweet_id in self.seen_ids:
+            return False
+        self.seen_ids.add(tweet_id)
+        self.seen_order.append(tweet_id)
+        if len(self.seen_order) > DEDUP_WINDOW:
+            self.seen_ids.discard(self.seen_order.popleft())
+        return True
 
     @tenacity.retry(wait=tenacity.wait_fixed(1), stop=tenacity.stop_after_attempt(3))
     def save_data_self(self, item):
+        if not self.remember(str(item["id"])):
+            self.duplicates += 1
+            return
+        # backfill pages come newest first and interleave with the live stream, so keep the newest tweet
+        if self.last_id is None or int(item["id"]) > int(self.last_id):
+            self.last_id, self.last_created_at = item["id"], item["created_at"]
         self.lines = self.lines + 1
         self.total_count += 1
         try:
-            if self.file_name is None or self.lines > self.lines_per_file:
-                if self.file_object is not None:
-                    self.file_object.close()
-                    os.rename("{}.tmp.gz".format(self.file_name), "{}.gz".format(self.file_name))
+            if self.file_object is None or self.lines > self.lines_per_file:
+                self.close_file()
 
                 self.file_name = os.path.join(self.file_path,
                                               "data-{}.jsonl".format(datetime.now().strftime("%Y%m%d_%H%M%S.%f")))
-                self.file_object = gzip.open("{}.tmp.gz".format(self.file_name), "at")
+                self.file_object = self.codec.open("{}.tmp{}".format(self.file_name, self.extension), "ab")
                 self.lines = 1
-                self.logger.info("switching files: {}.gz".format(self.file_name))
+                self.logger.info("switching files: {}{}".format(self.file_name, self.extension))
 
             logger.debug(f'item is {item}')
-            print(json.dumps(item, default=str), file=self.file_object, flush=True)
+            # flushed by the writer thread every flush_lines tweets or flush_interval seconds
+            started = time.perf_counter()
+            line = serializer.dumps_line(item)
+            metrics.SERIALIZE_SECONDS.observe(time.perf_counter() - started)
+            self.file_object.write(line)
+            metrics.TWEETS.inc()
+            metrics.BYTES_WRITTEN.inc(len(line))
             self.update_status()
         except Exception as e:
             self.logger.error("an error occurred while writing a line: {}".format(e))
@@ -299,15 +223,79 @@ class TwitterStreamer(StreamingClient):
         if self.total_count % 1000 == 0:  # log update status
             hours_elapsed = (time.time() - self.start_time) / 3600.0
             logger.info(f"collected {self.total_count} tweets in {hours_elapsed} hours.")
+            logger.info(f"writer queue: {self.writer.stats()}, duplicates skipped: {self.duplicates}")
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return None, None
+        with open(self.state_file, "rt") as f:
+            state = json.load(f)
+        logger.info(f"last persisted tweet: {state}")
+        return state.get("last_id"), state.get("last_created_at")
+
+    def save_state(self):
+        # the newest tweet that has reached the disk, where a backfill has to start from
+        if self.last_id is None:
+            return
+        with open(self.state_file + ".tmp", "wb") as f:
+            f.write(serializer.dumps_line({"last_id": self.last_id, "last_created_at": self.last_created_at}))
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def flush_file(self):
+        if self.file_object is not None:
+            self.file_object.flush()
+            self.save_state()
+
+    def on_connect(self):
+        super().on_connect()
+        self.connections += 1
+        if self.connections > 1:
+            metrics.RECONNECTS.inc()
+        if self.backfill is None or self.last_created_at is None:
+            return
+        # whatever was sent between the last tweet we wrote and now was missed
+        start_time = to_api_time(self.last_created_at)
+        thread = threading.Thread(target=self.run_backfill,
+                                  args=(start_time, self.last_id, datetime.now(timezone.utc)),
+                                  name="stream-backfill", daemon=True)
+        thread.start()
+
+    def run_backfill(self, start_time, after_id, connected_at):
+        with self.backfill_lock:
+            time.sleep(max(0.0, BACKFILL_DELAY - (datetime.now(timezone.utc) - connected_at).total_seconds()))
+            end_time = to_api_time(connected_at + timedelta(seconds=BACKFILL_DELAY - SEARCH_LAG))
+            if end_time <= start_time:
+                return
+            logger.info(f"backfilling the stream gap from {start_time} to {end_time}")
+            writer = BackfillWriter(self.writer, after_id)
+            try:
+                self.backfill(start_time, end_time, writer, self.normalizer)
+            except Exception as e:
+                logger.error(f"backfill from {start_time} to {end_time} failed: {e}")
+                logger.error(traceback.format_exc())
+            logger.info(f"backfill from {start_time} to {end_time} found {writer.total} tweets")
+
+    def close_file(self):
+        if self.file_object is None:
+            return
+        self.file_object.close()
+        self.file_object = None
+        os.rename("{}.tmp{}".format(self.file_name, self.extension), "{}{}".format(self.file_name, self.extension))
+        self.save_state()
 
     def on_exit(self):
         logger.debug("existing streamer")
         try:
             self.disconnect()
-            self.file_object.close()
-            os.rename("{}.tmp.gz".format(self.file_name), "{}.gz".format(self.file_name))
         except:
             pass
+        # write out whatever is still queued before the last file is closed
+        self.writer.stop()
+        try:
+            self.close_file()
+        except:
+            pass
+        logger.info(f"writer queue: {self.writer.stats()}, duplicates skipped: {self.duplicates}")
 
 
 def get_bearer_token(file_name):
@@ -321,16 +309,30 @@ def get_query(file_name):
         return json.load(f)
 
 
+def make_backfill(credentials, query, tweet_fields, user_fields, expansion_fields, place_fields, media_fields):
+    """
+    A rule-equivalent full archive search over a gap, paginated by
+    search2.get_tweets. The streamer passes its own normalizer, so the
+    backfilled records have the same fields as the live ones.
+    """
+    # imported here: search2 sets up its own log file on import, which a stream without backfill does not need
+    import search2
+
+    def backfill(start_time, end_time, writer, normalizer=None):
+        search_query = dict(query, name="%s_backfill" % query.get('name', 'stream'), start_time=start_time,
+                            end_time=end_time, max_results=query.get('backfill_max_results', 500),
+                            max_pages=query.get('backfill_max_pages', 1000))
+        search_query.pop('pagination_token', None)
+        return search2.get_tweets(credentials, search_query, None, tweet_fields, user_fields, expansion_fields,
+                                  place_fields or "", media_fields or "", writer=writer, page_normalizer=normalizer)
+    return backfill
+
+
 def run(credential_file, query_file, output_dir):
     bearer_token = get_bearer_token(credential_file)
     query = get_query(query_file)
     logger.info(f'query is {query}')
-
-    streamer = TwitterStreamer(bearer_token, query['limit'], output_dir, wait_on_rate_limit=True)
-
-    # add rules
-    rules = StreamRule(value=query['query'])
-    streamer.add_rules(rules)
+    metrics.start_from_query(query)
 
     # set fields
     user_fields = "created_at,description,entities,id,location,name,protected,public_metrics,url,username,verified,withheld"
@@ -358,6 +360,32 @@ def run(credential_file, query_file, output_dir):
     logger.info(f'place_fields: {place_fields}')
     logger.info(f'media_fields: {media_fields}')
 
+    writer_options = {
+        "max_queue": query.get('writer_queue_size', 10000),
+        "block": query.get('writer_queue_full', 'block') != 'drop',
+        "flush_interval": query.get('flush_interval', 5.0),
+        "flush_lines": query.get('flush_lines', 1000),
+    }
+    if query.get('spill', False):
+        # past spill_threshold queued responses, raw data goes to an on-disk log instead of waiting
+        spill_dir = query.get('spill_dir', os.path.join(output_dir, '.spill'))
+        writer_options['spill'] = SpillLog(spill_dir, segment_size=query.get('spill_segment_mb', 64) * 1024 * 1024)
+        writer_options['spill_threshold'] = query.get('spill_threshold')
+
+    # after a disconnect or restart, search for the tweets sent while we were away
+    backfill = None
+    if query.get('backfill', True):
+        backfill = make_backfill(get_query(credential_file), query, tweet_fields, user_fields, expansion_fields,
+                                 place_fields, media_fields)
+
+    streamer = TwitterStreamer(bearer_token, query['limit'], output_dir, raw=query.get('raw_responses', False),
+                               writer_options=writer_options, codec=compression.codec_from_query(query),
+                               backfill=backfill, wait_on_rate_limit=True)
+
+    # add rules
+    rules = StreamRule(value=query['query'])
+    streamer.add_rules(rules)
+
     # start data stream
     streamer.filter(user_fields=user_fields, tweet_fields=tweet_fields, place_fields=place_fields,
                     media_fields=media_fields, expansions=expansion_fields)
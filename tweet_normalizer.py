@@ -0,0 +1,283 @@
+"""
+One place that turns Twitter APIv2 tweets into the flat records our scripts
+write out. It works on raw JSON dicts and on tweepy model objects alike, since
+both support tweet["field"] and tweet.get("field").
+
+The field mappings below are compiled once into plain Python functions, so a
+record is built with one dict literal and each nested object (such as
+public_metrics) is looked up once per tweet instead of once per field.
+"""
+
+from collections.abc import Mapping
+from datetime import datetime
+
+
+def get_hashtags(entities):
+    if not entities:
+        return
+
+    hashtags = entities.get('hashtags')
+    if not hashtags:
+        return
+
+    return [h['tag'] for h in hashtags]
+
+
+def get_expanded_urls(entities):
+    if not entities:
+        return
+
+    urls = entities.get('urls')
+    if not urls:
+        return
+
+    return [h['expanded_url'] for h in urls]
+
+
+def list_hashtags(entities):
+    return [x["tag"] for x in (entities or {}).get("hashtags", [])]
+
+
+def list_expanded_urls(entities):
+    return [x["expanded_url"] for x in (entities or {}).get("urls", [])]
+
+
+def to_str_time(value):
+    # tweepy models carry datetimes; write them the way json.dumps(default=str) always did,
+    # "2022-10-01 12:00:00+00:00", so the serializer never needs its fallback for them
+    return str(value) if isinstance(value, datetime) else value
+
+
+def get_media_view_count(media):
+    if 'public_metrics' not in media:
+        return
+    return media.get("public_metrics").get("view_count", None)
+
+
+# Field mappings are (output key, source path) or (output key, source path, transform).
+# A path reads from the tweet unless it starts with "author:". Dots walk into nested
+# objects and a leading "?" means the field is optional (None when missing).
+
+TWEET_FIELDS = [
+    ("id", "id"),
+    ("conversation_id", "conversation_id"),
+    ("created_at", "created_at", to_str_time),
+    ("tweet", "text"),
+    ("hashtags", "?entities", get_hashtags),
+    ("urls", "?entities", get_expanded_urls),
+    ("source", "?source"),
+    ("language", "lang"),
+    ("retweet_count", "public_metrics.retweet_count"),
+    ("reply_count", "public_metrics.reply_count"),
+    ("like_count", "public_metrics.like_count"),
+    ("quote_count", "public_metrics.quote_count"),
+    ("in_reply_to_user_id", "?in_reply_to_user_id"),
+    ("possibly_sensitive", "possibly_sensitive"),
+    ("reply_settings", "reply_settings"),
+]
+
+AUTHOR_FIELDS = [
+    ("user_id", "author_id"),
+    ("user_screen_name", "author:username"),
+    ("user_name", "author:name"),
+    ("user_description", "author:description"),
+    ("user_location", "author:?location"),
+    ("user_created_at", "author:created_at", to_str_time),
+    ("user_followers_count", "author:public_metrics.followers_count"),
+    ("user_friends_count", "author:public_metrics.following_count"),
+    ("user_statuses_count", "author:public_metrics.tweet_count"),
+    ("user_verified", "author:verified"),
+]
+
+TRAILER_FIELDS = [
+    ("references", "?referenced_tweets"),
+    ("context_annotations", "?context_annotations"),
+]
+
+# what search2.py, stream.py, fetch_tweets_by_ids.py and fetch_user_tweets2.py write
+FULL_FIELDS = TWEET_FIELDS[:4] + [("entities", "?entities")] + TWEET_FIELDS[4:] + AUTHOR_FIELDS + TRAILER_FIELDS
+
+# what fetch_tweet_replies.py writes
+REPLY_FIELDS = TWEET_FIELDS + AUTHOR_FIELDS + TRAILER_FIELDS
+
+# what search.py, hydrate.py and fetch_user_tweets.py write
+LEGACY_FIELDS = (
+    TWEET_FIELDS[:4]
+    + [("hashtags", "?entities", list_hashtags), ("urls", "?entities", list_expanded_urls)]
+    + TWEET_FIELDS[6:13]
+    + AUTHOR_FIELDS
+    + [("references", "?referenced_tweets")]
+)
+
+MEDIA_FIELDS = [
+    ("media_key", "media_key"),
+    ("media_type", "type"),
+    ("media_view_count", "", get_media_view_count),
+    ("media_height", "?height"),
+    ("media_width", "?width"),
+    ("media_url", "?url"),
+    ("media_preview_image_url", "?preview_image_url"),
+    ("media_variants", "?variants"),
+    ("media_alt_text", "?alt_text"),
+]
+
+PLACE_FIELDS = [
+    ("id", "?id"),
+    ("full_name", "?full_name"),
+    ("contained_within", "?contained_within"),
+    ("country", "?country"),
+    ("country_code", "?country_code"),
+    ("geo", "?geo"),
+    ("name", "?name"),
+    ("place_type", "?place_type"),
+]
+
+
+def compile_fields(fields, name="extract"):
+    """
+    Build a function f(tweet, author) that returns the record described by fields.
+
+    The function is generated as source code so the result is a single dict
+    literal with every nested object fetched into a local variable once.
+    """
+    namespace = {}
+    hoisted = {}  # (source, parent) -> local variable name
+    lines = []
+    items = []
+
+    for index, field in enumerate(fields):
+        key, path = field[0], field[1]
+        transform = field[2] if len(field) > 2 else None
+
+        source = "tweet"
+        if path.startswith("author:"):
+            source, path = "author", path[len("author:"):]
+
+        if not path:
+            expression = source
+        else:
+            parts = path.split(".")
+            target = source
+            for parent in parts[:-1]:
+                if (target, parent) not in hoisted:
+                    variable = "_{}_{}".format(len(hoisted), parent)
+                    lines.append("    {} = {}[{!r}]".format(variable, target, parent))
+                    hoisted[(target, parent)] = variable
+                target = hoisted[(target, parent)]
+
+            leaf = parts[-1]
+            if leaf.startswith("?"):
+                expression = "{}.get({!r})".format(target, leaf[1:])
+            else:
+                expression = "{}[{!r}]".format(target, leaf)
+
+        if transform is not None:
+            namespace["_transform_{}".format(index)] = transform
+            expression = "_transform_{}({})".format(index, expression)
+
+        items.append("        {!r}: {},".format(key, expression))
+
+    source_code = "def {}(tweet, author=None):\n{}\n    return {{\n{}\n    }}\n".format(
+        name, "\n".join(lines), "\n".join(items))
+    exec(compile(source_code, "<tweet_normalizer {}>".format(name), "exec"), namespace)
+    extractor = namespace[name]
+    extractor.source = source_code
+    return extractor
+
+
+def response_parts(response):
+    """(data, includes, meta) of a raw JSON page or of a tweepy Response."""
+    if isinstance(response, Mapping):
+        return response.get("data"), response.get("includes"), response.get("meta", {})
+    return response.data, response.includes, getattr(response, "meta", {})
+
+
+def _as_list(items):
+    if items is None:
+        return []
+    if isinstance(items, Mapping):
+        return [items]  # a stream response carries a single tweet
+    return items
+
+
+class TweetNormalizer:
+    """
+    Turns a page of API results into flat tweet records.
+
+    fields is the mapping for the main tweets. Referenced tweets found in the
+    includes are attached as references_<type>; ref_authors controls whether
+    they carry their author's fields. Media and places are attached as
+    media_objects and place_object when the includes have them.
+    """
+
+    def __init__(self, fields=FULL_FIELDS, references=True, ref_authors=True, media=True, places=False):
+        self.extract = compile_fields(fields, "extract_tweet")
+        self.extract_ref = compile_fields(TWEET_FIELDS, "extract_ref_tweet")
+        self.extract_ref_author = compile_fields(AUTHOR_FIELDS, "extract_ref_author")
+        self.extract_media = compile_fields(MEDIA_FIELDS, "extract_media")
+        self.extract_place = compile_fields(PLACE_FIELDS, "extract_place")
+        self.references = references
+        self.ref_authors = ref_authors
+        self.media = media
+        self.places = places
+
+    @staticmethod
+    def index_includes(includes):
+        """Key the users, tweets, media and places of an includes object by id."""
+        includes = includes or {}
+        return (
+            {u["id"]: u for u in includes.get("users", [])},
+            {t["id"]: t for t in includes.get("tweets", [])},
+            {m["media_key"]: m for m in includes.get("media", [])},
+            {p["id"]: p for p in includes.get("places", [])},
+        )
+
+    def parse_ref_tweet(self, tweet, users):
+        obj = self.extract_ref(tweet)
+        if self.ref_authors:
+            author = users.get(tweet["author_id"])
+            if author:
+                obj.update(self.extract_ref_author(tweet, author))
+        return obj
+
+    def parse_tweet(self, tweet, users, includes_tweets=None, includes_media=None, includes_places=None):
+        obj = self.extract(tweet, users.get(tweet["author_id"]))
+
+        if self.references and includes_tweets:
+            for ref in tweet.get("referenced_tweets") or ():
+                ref_tweet = includes_tweets.get(ref["id"])
+                if ref_tweet is not None:
+                    obj["references_%s" % ref["type"]] = self.parse_ref_tweet(ref_tweet, users)
+
+        if self.media and includes_media:
+            attachments = tweet.get("attachments")
+            if attachments and "media_keys" in attachments:
+                obj["media_objects"] = [
+                    self.extract_media(includes_media[key])
+                    for key in attachments["media_keys"] if includes_media.get(key)
+                ]
+
+        if self.places and includes_places:
+            geo = tweet.get("geo")
+            if geo is not None and "place_id" in geo and geo["place_id"] in includes_places:
+                obj["place_object"] = self.extract_place(includes_places[geo["place_id"]])
+
+        return obj
+
+    def normalize_page(self, response, on_error=None):
+        """
+        Normalize every tweet in a response (a raw JSON dict or a tweepy
+        Response) in one call. A tweet that fails to parse is passed to
+        on_error(tweet, exception) when given, otherwise the error is raised.
+        """
+        data, includes, _ = response_parts(response)
+        users, includes_tweets, includes_media, includes_places = self.index_includes(includes)
+        results = []
+        for tweet in _as_list(data):
+            try:
+                results.append(self.parse_tweet(tweet, users, includes_tweets, includes_media, includes_places))
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(tweet, e)
+        return results